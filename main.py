@@ -11,15 +11,29 @@ import random
 import signal
 import sys
 import aiohttp
-from telegram import Update
-from telegram.ext import Application, MessageHandler, filters, ContextTypes, CommandHandler
-from telegram.error import Conflict
-from collections import deque, defaultdict
-import numpy as np
+from aiohttp import web
+import hmac
+import threading
+import subprocess
+import secrets
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from telegram import Bot, Update
+from telegram.constants import ChatAction
+from telegram.ext import Application, MessageHandler, filters, ContextTypes, CommandHandler, SimpleUpdateProcessor
+from telegram.error import BadRequest, Conflict, NetworkError, RetryAfter, TelegramError
+from collections import deque, defaultdict, OrderedDict, Counter
+from collections.abc import Mapping
 import humanize
 from dateutil import parser
 from typing import Dict, Any, List, Optional
 import hashlib
+import math
+import zlib
+import numpy as np
+from functools import lru_cache
+import heapq
+from contextlib import asynccontextmanager
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,16 +42,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Обработчик сигналов для graceful shutdown
-def signal_handler(sig, frame):
-    print("\n🛑 Останавливаю бота...")
-    if 'application' in globals() and application.running:
-        application.stop()
-    sys.exit(0)
-
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
 # Ваши ключи
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 YANDEX_API_KEY = os.getenv("YANDEX_API_KEY")
@@ -46,8 +50,258 @@ YANDEX_FOLDER_ID = os.getenv("YANDEX_FOLDER_ID")
 # URL API Yandex GPT
 YANDEX_API_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
 
+# Ответ, когда очередь к модели переполнена
+BUSY_RESPONSE = "Ой, у меня сейчас столько разговоров сразу... Напиши мне через минутку? 🙏"
+
+# Настройки хранилища
+DB_NAME = os.getenv("DB_NAME", "bot_users.db")
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "200"))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "500"))
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "300"))
+DB_EXPLAIN_ON_STARTUP = os.getenv("DB_EXPLAIN_ON_STARTUP", "1") == "1"
+
+# Настройки клиента Yandex GPT
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "100"))
+LLM_POOL_PER_HOST = int(os.getenv("LLM_POOL_PER_HOST", "32"))
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv("LLM_KEEPALIVE_TIMEOUT", "60"))
+LLM_DNS_CACHE_TTL = int(os.getenv("LLM_DNS_CACHE_TTL", "300"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "30"))
+LLM_TOTAL_TIMEOUT = float(os.getenv("LLM_TOTAL_TIMEOUT", "60"))
+
+# Планировщик запросов к модели
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "10"))
+LLM_REQUESTS_PER_SECOND = float(os.getenv("LLM_REQUESTS_PER_SECOND", "10"))
+LLM_TOKENS_PER_SECOND = float(os.getenv("LLM_TOKENS_PER_SECOND", "20000"))
+LLM_MAX_QUEUE_WAIT = float(os.getenv("LLM_MAX_QUEUE_WAIT", "20"))
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "150"))
+
+# Бюджет токенов промпта с глубоким контекстом
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1000"))
+
+# Лимит длины ответа модели (maxTokens) по пути генерации и стилю беседы
+COMPLETION_MAX_TOKENS = {
+    'new_user': {'default': 120},
+    'fallback': {'default': 150},
+    'deep': {'active': 400, 'reactive': 250, 'balanced': 300, 'deep': 500, 'default': 300}
+}
+
+# Склейка сообщений, отправленных подряд (0 - без склейки)
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.0"))
+COALESCE_MAX_DELAY = float(os.getenv("COALESCE_MAX_DELAY", "4.0"))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "10"))
+
+# Полосы выполнения по пользователям
+LANE_MAX_PENDING = int(os.getenv("LANE_MAX_PENDING", "3"))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "256"))
+
+# Прием обновлений: вебхук, если задан WEBHOOK_URL, иначе long polling.
+# Кэш контекста, полосы пользователей и векторная память живут в процессе,
+# поэтому не запускайте несколько независимых процессов за балансировщиком:
+# для нескольких ядер есть python main.py supervise, он закрепляет каждого
+# пользователя за одним воркером. WEBHOOK_REGISTER=0 - не вызывать setWebhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+
+# Режим супервизора (python main.py supervise): WORKER_PROCESSES процессов-воркеров,
+# обновления распределяются по стабильному хешу user_id. Воркер N слушает
+# WEBHOOK_PORT + 1 + N на localhost; при WORKER_SHARD_DATABASES=1 у каждого
+# воркера своя база (тогда WORKER_PROCESSES задается явно и не меняется:
+# от него зависит, в какой базе лежит пользователь), иначе все работают
+# с общей базой в режиме WAL
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+WORKER_INDEX = os.getenv("WORKER_INDEX", "")
+WORKER_SHARD_DATABASES = os.getenv("WORKER_SHARD_DATABASES", "0") == "1"
+WORKER_STARTUP_TIMEOUT = float(os.getenv("WORKER_STARTUP_TIMEOUT", "60"))
+
+# Обработчики используют только обычные сообщения: остальные типы обновлений не запрашиваем
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+# Идемпотентность: сколько обработанных сообщений помнить в памяти и сколько часов в базе
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_RETENTION_HOURS = float(os.getenv("IDEMPOTENCY_RETENTION_HOURS", "48"))
+
+# Сколько секунд после SIGTERM/SIGINT даем начатым ходам завершиться
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+
+# Исходящие сообщения: общий лимит бота и лимит на чат (сообщений в секунду)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+
+# Потоковые ответы
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_MAX_EDITS = int(os.getenv("STREAM_MAX_EDITS", "20"))
+
+# Дополнительные стоп-слова для извлечения тем (через запятую)
+TOPIC_EXTRA_STOP_WORDS = os.getenv("TOPIC_EXTRA_STOP_WORDS", "")
+
+# Затухание накопленной статистики беседы на одно сообщение: по умолчанию 1.0 -
+# без затухания, дуга отражает все отношения; 0.95 - примерно последние 20 сообщений
+CONVERSATION_STATS_DECAY = float(os.getenv("CONVERSATION_STATS_DECAY", "1.0"))
+
+# Стадия анализа сообщений: пул потоков (thread) или процессов (process)
+ANALYSIS_POOL = os.getenv("ANALYSIS_POOL", "thread")
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "4"))
+
+# Сколько последних упоминаний каждой темы рассматривать при поиске воспоминаний
+MEMORY_RECALL_PER_TOPIC = int(os.getenv("MEMORY_RECALL_PER_TOPIC", "50"))
+
+# Векторная память сообщений (хешированные символьные n-граммы)
+MEMORY_VECTOR_DIM = int(os.getenv("MEMORY_VECTOR_DIM", "256"))
+MEMORY_VECTOR_DIR = os.getenv("MEMORY_VECTOR_DIR", "memory_vectors")
+MEMORY_VECTOR_MMAP_ROWS = int(os.getenv("MEMORY_VECTOR_MMAP_ROWS", "5000"))
+MEMORY_VECTOR_CACHE_USERS = int(os.getenv("MEMORY_VECTOR_CACHE_USERS", "1000"))
+MEMORY_VECTOR_CACHE_MB = float(os.getenv("MEMORY_VECTOR_CACHE_MB", "256"))
+MEMORY_VECTOR_TOP_K = int(os.getenv("MEMORY_VECTOR_TOP_K", "5"))
+MEMORY_VECTOR_MIN_SIMILARITY = float(os.getenv("MEMORY_VECTOR_MIN_SIMILARITY", "0.15"))
+
+# Фоновое резюме беседы: раз в N сообщений (0 - выключено), не больше
+# SUMMARY_MAX_BATCH новых обменов за раз, резюме не длиннее SUMMARY_MAX_CHARS
+SUMMARY_EVERY_MESSAGES = int(os.getenv("SUMMARY_EVERY_MESSAGES", "20"))
+SUMMARY_MAX_BATCH = int(os.getenv("SUMMARY_MAX_BATCH", "40"))
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "800"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+SUMMARY_LLM_WEIGHT = float(os.getenv("SUMMARY_LLM_WEIGHT", "0.1"))
+
+# Кэш анализа сообщений (по тексту)
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "20000"))
+
+# Настройки кэша контекста
+CONTEXT_CACHE_MAX_USERS = int(os.getenv("CONTEXT_CACHE_MAX_USERS", "5000"))
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "1800"))
+
+class ContextCache:
+    """Ограниченный LRU/TTL кэш контекста пользователей.
+    
+    Чтение идет через кэш (read-through), а сохранение обменов, фактов и
+    личности бота обновляет закэшированную запись (write-through), поэтому
+    активные беседы обслуживаются из памяти.
+    """
+    
+    def __init__(self, max_entries=CONTEXT_CACHE_MAX_USERS, ttl=CONTEXT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._filling = {}
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+    
+    @staticmethod
+    def _snapshot(context: Dict[str, Any]) -> Dict[str, Any]:
+        """Копия записи, которую обработчик может держать между await"""
+        return dict(context, history=list(context['history']), user_facts=dict(context['user_facts']))
+    
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Получение контекста из кэша или None"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self._stats['misses'] += 1
+            return None
+        
+        expires_at, context = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            self._stats['expirations'] += 1
+            self._stats['misses'] += 1
+            return None
+        
+        self._entries.move_to_end(user_id)
+        self._stats['hits'] += 1
+        return self._snapshot(context)
+    
+    def begin_fill(self, user_id: int) -> object:
+        """Метка начала чтения из базы; запись в кэш после записи в базу отменяет ее"""
+        token = object()
+        self._filling[user_id] = token
+        return token
+    
+    def fill(self, user_id: int, token: object, context: Dict[str, Any]):
+        """Помещение прочитанного из базы контекста, если он не устарел за время чтения"""
+        if self._filling.get(user_id) is not token:
+            return
+        del self._filling[user_id]
+        
+        self._entries[user_id] = (time.monotonic() + self.ttl, self._snapshot(context))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+    
+    def _cached(self, user_id: int) -> Optional[Dict[str, Any]]:
+        self._filling.pop(user_id, None)
+        entry = self._entries.get(user_id)
+        return entry[1] if entry else None
+    
+    def apply_exchange(self, user_id: int, exchange: Dict[str, Any]):
+        """Write-through для save_complete_context"""
+        context = self._cached(user_id)
+        if context is None:
+            return
+        
+        deep_context = exchange['deep_context']
+        context['history'].insert(0, {
+            'user': exchange['user_message'],
+            'bot': exchange['bot_response'],
+            'timestamp': datetime.fromisoformat(exchange['timestamp']),
+            'emotional_score': exchange['emotional_state'].get('intensity', 0.5),
+            'topics': exchange['topics'],
+            'analysis': exchange['analysis']
+        })
+        del context['history'][20:]
+        context['messages_count'] = (context.get('messages_count') or 0) + 1
+        context['last_interaction'] = exchange['timestamp']
+        context['deep_context'] = dict(deep_context)
+        if exchange['conversation_stats'] is not None:
+            context['conversation_stats'] = exchange['conversation_stats']
+    
+    def apply_fact(self, user_id: int, fact_type: str, fact_value: str):
+        """Write-through для save_user_fact"""
+        context = self._cached(user_id)
+        if context is not None:
+            context['user_facts'][fact_type] = fact_value
+    
+    def apply_personality(self, user_id: int, personality: Dict[str, Any]):
+        """Write-through для save_bot_personality"""
+        context = self._cached(user_id)
+        if context is not None:
+            context['bot_personality'] = personality
+    
+    def apply_summary(self, user_id: int, summary: str):
+        """Write-through для резюме беседы"""
+        context = self._cached(user_id)
+        if context is not None:
+            context['conversation_summary'] = summary
+    
+    def invalidate(self, user_id: int):
+        """Удаление пользователя из кэша"""
+        self._filling.pop(user_id, None)
+        self._entries.pop(user_id, None)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий, промахов и вытеснений для подбора бюджета"""
+        lookups = self._stats['hits'] + self._stats['misses']
+        return {
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self._stats['hits'],
+            'misses': self._stats['misses'],
+            'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else 0.0,
+            'evictions': self._stats['evictions'],
+            'expirations': self._stats['expirations']
+        }
+
 # Контекст беседы для каждого пользователя
-conversation_context = {}
+conversation_context = ContextCache()
 
 class PersonalityGenerator:
     """Генератор персонажа и личности бота"""
@@ -159,6 +413,251 @@ class PersonalityGenerator:
                 'me': 'мне'
             }
 
+class LexiconMatcher:
+    """Поиск всех лексиконов за один проход по тексту.
+    
+    Все триггеры всех категорий собираются в одно регулярное выражение в
+    виде префиксного дерева (по сути автомат), которое в каждой позиции
+    находит самый длинный триггер. Более короткие триггеры, начинающиеся в
+    той же позиции, - его префиксы, они вычисляются заранее. Поэтому
+    стоимость разбора не зависит от числа лексиконов, а сами лексиконы
+    могут расти до тысяч записей. Семантика - как у `trigger in text`.
+    """
+    
+    def __init__(self, lexicons: Dict[str, List[str]]):
+        self.categories = defaultdict(set)
+        for category, triggers in lexicons.items():
+            for trigger in triggers:
+                if trigger:
+                    self.categories[trigger.lower()].add(category)
+        
+        self._prefixes = {
+            trigger: [other for other in self.categories if trigger.startswith(other)]
+            for trigger in self.categories
+        }
+        self._pattern = re.compile(f"(?=({self._trie_pattern(self.categories)}))")
+    
+    @staticmethod
+    def _trie_pattern(triggers):
+        """Регулярное выражение по префиксному дереву триггеров"""
+        trie = {}
+        for trigger in triggers:
+            node = trie
+            for char in trigger:
+                node = node.setdefault(char, {})
+            node[''] = True
+        
+        def build(node):
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ''
+            body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+            return f'(?:{body})?' if '' in node else body
+        
+        return build(trie)
+    
+    def find(self, text: str) -> set:
+        """Все триггеры, встречающиеся в тексте"""
+        found = set()
+        for match in self._pattern.finditer(text):
+            found.update(self._prefixes[match.group(1)])
+        return found
+    
+    def count(self, text: str) -> Dict[str, int]:
+        """Число различных триггеров каждой категории в тексте (текст в нижнем регистре)"""
+        counts = {}
+        for trigger in self.find(text):
+            for category in self.categories[trigger]:
+                counts[category] = counts.get(category, 0) + 1
+        return counts
+
+class PatternMatcher:
+    """Набор регулярных выражений с одной группой, проверяемых за один проход.
+    
+    Шаблоны объединяются в одну альтернацию внутри опережающей проверки,
+    поэтому совпадения ищутся в каждой позиции текста, а для каждого
+    шаблона запоминается первое совпадение - как у re.search.
+    """
+    
+    def __init__(self, patterns: List[str]):
+        alternatives = [
+            pattern.replace('(', f'(?P<g{index}>', 1)
+            for index, pattern in enumerate(patterns)
+        ]
+        self._pattern = re.compile('(?=(?:' + '|'.join(alternatives) + '))')
+    
+    def first_matches(self, text: str) -> Dict[int, str]:
+        """Индекс шаблона -> значение группы в его первом совпадении"""
+        found = {}
+        for match in self._pattern.finditer(text):
+            for name, value in match.groupdict().items():
+                if value is not None:
+                    found.setdefault(int(name[1:]), value)
+        return found
+
+# Лексиконы: категория -> триггеры (ищутся как подстроки текста в нижнем регистре)
+LEXICONS = {
+    # Эмоции
+    'joy': ['рад', 'счастлив', 'ура', 'класс', 'супер'],
+    'sadness': ['грустно', 'печально', 'плохо', 'тяжело'],
+    'anger': ['злой', 'сердит', 'бесит', 'ненавижу'],
+    'excitement': ['!', '!!', '!!!', 'вау', 'ого'],
+    'confusion': ['?', '??', '???', 'не понимаю', 'запутался'],
+    # Эмоциональный скор
+    'positive': ['рад', 'счастлив', 'хорошо', 'отлично'],
+    'negative': ['грустно', 'плохо', 'ненавижу', 'злой'],
+    # Личные вопросы
+    'ask_bot_name': ['как тебя зовут', 'твое имя', 'как зовут'],
+    'ask_bot_age': ['сколько тебе лет', 'твой возраст', 'какой возраст'],
+    'ask_bot_gender': ['ты парень', 'ты девушка', 'ты мужчина', 'ты женщина', 'ты мужик'],
+    'ask_user_name': ['как меня зовут', 'мое имя', 'меня звать'],
+    'ask_user_age': ['сколько мне лет', 'мой возраст']
+}
+
+# Шаблоны персональной информации в порядке приоритета
+FACT_PATTERNS = [
+    ('name', r'меня зовут (\w+)'), ('name', r'я (\w+)'), ('name', r'зовут (\w+)'),
+    ('name', r'мое имя (\w+)'), ('name', r'имя (\w+)'), ('name', r'звать (\w+)'),
+    ('age', r'мне (\d+) лет'), ('age', r'мне (\d+) год'), ('age', r'возраст (\d+)'),
+    ('age', r'(\d+) лет'), ('age', r'(\d+) год'),
+    ('interests', r'люблю ([^.!?]+)'), ('interests', r'нравится ([^.!?]+)'),
+    ('interests', r'увлекаюсь ([^.!?]+)'), ('interests', r'занимаюсь ([^.!?]+)'),
+    ('interests', r'хобби ([^.!?]+)'), ('interests', r'интересуюсь ([^.!?]+)')
+]
+
+lexicon_matcher = LexiconMatcher(LEXICONS)
+fact_matcher = PatternMatcher([pattern for _, pattern in FACT_PATTERNS])
+
+class TopicExtractor:
+    """Извлечение тем сообщения за линейное время.
+    
+    Слова считаются за один проход (Counter), вес слова - 0.3 за каждое вхождение
+    плюс бонус, если слово встречается в начале сообщения (первые
+    lead_chars символов), а лучшие top_k выбираются кучей без сортировки
+    всего словаря.
+    """
+    
+    TOKEN_PATTERN = re.compile(r'\b[а-яё]{3,}\b')
+    DEFAULT_STOP_WORDS = frozenset({
+        'этот', 'эта', 'это', 'эти', 'очень', 'который', 'которая', 'которые', 'когда',
+        'потом', 'тогда', 'вообще', 'значит', 'что', 'как', 'так', 'там', 'тут', 'для',
+        'все', 'всё', 'еще', 'ещё', 'уже', 'или', 'если', 'чтобы', 'меня', 'тебя', 'тебе',
+        'мне', 'мой', 'моя', 'твой', 'его', 'она', 'они', 'мы', 'вы', 'был', 'была',
+        'было', 'быть', 'есть', 'нет', 'даже', 'только', 'тоже', 'просто', 'может',
+        'где', 'чем', 'кто', 'ну', 'вот', 'про', 'без', 'над', 'под', 'при'
+    })
+    
+    def __init__(self, stop_words=None, top_k=5, count_weight=0.3, lead_bonus=0.2, lead_chars=50):
+        self.stop_words = frozenset(stop_words) if stop_words is not None else self.DEFAULT_STOP_WORDS
+        self.top_k = top_k
+        self.count_weight = count_weight
+        self.lead_bonus = lead_bonus
+        self.lead_chars = lead_chars
+    
+    def extract_with_tokens(self, text):
+        """Токены сообщения и темы с весами"""
+        lowered = text.lower()
+        tokens = self.TOKEN_PATTERN.findall(lowered)
+        counts = Counter(tokens)
+        for word in self.stop_words & counts.keys():
+            del counts[word]
+        
+        # Слова, целиком попавшие в начало сообщения (endpos отсекает обрезанное слово)
+        lead = {
+            match.group()
+            for match in self.TOKEN_PATTERN.finditer(lowered, 0, self.lead_chars + 1)
+            if match.end() <= self.lead_chars
+        }
+        
+        best = heapq.nlargest(
+            self.top_k,
+            ((word, min(1.0, count * self.count_weight + (self.lead_bonus if word in lead else 0)))
+             for word, count in counts.items()),
+            key=lambda item: item[1]
+        )
+        return tokens, dict(best)
+    
+    def extract(self, text):
+        """Темы сообщения с весами"""
+        return self.extract_with_tokens(text)[1]
+
+topic_extractor = TopicExtractor(
+    stop_words=TopicExtractor.DEFAULT_STOP_WORDS | {
+        word.strip().lower() for word in TOPIC_EXTRA_STOP_WORDS.split(',') if word.strip()
+    }
+)
+
+class ConversationStats:
+    """Накопленная статистика беседы, обновляемая за O(1) на сообщение.
+    
+    Хранит взвешенные суммы для линейной регрессии эмоционального скора по
+    номеру сообщения, его дисперсии и среднего интервала между сообщениями.
+    Номер отсчитывается от последнего сообщения (оно всегда в x = 0), поэтому
+    суммы не растут с длиной беседы. Вклад старых сообщений затухает с
+    коэффициентом decay на каждое новое сообщение.
+    """
+    
+    # Перерыв дольше часа - новая сессия, в ритм беседы он не входит
+    SESSION_GAP = 3600
+    FIELDS = ('count', 'weight', 'sum_x', 'sum_xx', 'sum_y', 'sum_yy', 'sum_xy',
+              'gap_weight', 'gap_sum', 'last_score', 'last_timestamp')
+    
+    def __init__(self, data: Optional[Dict[str, Any]] = None, decay=CONVERSATION_STATS_DECAY):
+        self.decay = decay
+        data = data or {}
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field, 0))
+        self.last_timestamp = data.get('last_timestamp')
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+    
+    def update(self, score: float, timestamp: datetime):
+        """Учет нового сообщения пользователя"""
+        # Сдвиг всех прошлых сообщений на одну позицию назад: x -> x - 1
+        self.sum_xy -= self.sum_y
+        self.sum_xx += self.weight - 2 * self.sum_x
+        self.sum_x -= self.weight
+        
+        decay = self.decay
+        self.weight = self.weight * decay + 1
+        self.sum_x *= decay
+        self.sum_xx *= decay
+        self.sum_xy *= decay
+        self.sum_y = self.sum_y * decay + score
+        self.sum_yy = self.sum_yy * decay + score * score
+        
+        if self.last_timestamp:
+            gap = (timestamp - datetime.fromisoformat(self.last_timestamp)).total_seconds()
+            if 0 <= gap <= self.SESSION_GAP:
+                self.gap_weight = self.gap_weight * decay + 1
+                self.gap_sum = self.gap_sum * decay + gap
+        
+        self.count += 1
+        self.last_score = score
+        self.last_timestamp = timestamp.isoformat(sep=' ')
+    
+    @property
+    def slope(self) -> float:
+        """Наклон эмоционального скора на одно сообщение"""
+        denominator = self.weight * self.sum_xx - self.sum_x ** 2
+        if self.count < 3 or denominator <= 1e-9:
+            return 0.0
+        return (self.weight * self.sum_xy - self.sum_x * self.sum_y) / denominator
+    
+    @property
+    def volatility(self) -> float:
+        """Стандартное отклонение эмоционального скора"""
+        if self.count < 2:
+            return 0.0
+        mean = self.sum_y / self.weight
+        return math.sqrt(max(0.0, self.sum_yy / self.weight - mean * mean))
+    
+    @property
+    def mean_gap(self) -> Optional[float]:
+        """Средний интервал между сообщениями в секундах"""
+        return self.gap_sum / self.gap_weight if self.gap_weight else None
+
 class DeepContextAnalyzer:
     """Глубокий анализ контекста беседы"""
     
@@ -166,39 +665,36 @@ class DeepContextAnalyzer:
         self.topic_memory = defaultdict(lambda: {'count': 0, 'last_mentioned': None, 'sentiment': 0.5})
         self.conversation_flow = deque(maxlen=10)
         
-    def extract_deep_context(self, message, history, user_context):
-        """Извлечение глубокого контекста из всей беседы"""
-        context = {
-            'current_topics': self._extract_topics(message),
-            'historical_topics': self._analyze_historical_topics(history),
-            'emotional_arc': self._analyze_emotional_arc(history),
-            'conversation_rhythm': self._analyze_conversation_rhythm(history),
-            'unfinished_threads': self._find_unfinished_threads(history),
-            'user_patterns': self._analyze_user_patterns(history, user_context)
-        }
-        return context
+    def extract_deep_context(self, message, history, user_context, stats):
+        """Глубокий контекст беседы; секции вычисляются при первом обращении"""
+        return DeepContext(self, message, history, user_context, stats)
+    
+    def compute_section(self, section, message, history, user_context, stats):
+        """Вычисление одной секции глубокого контекста"""
+        if section == 'current_topics':
+            return analyze_message(message)['topics']
+        if section == 'historical_topics':
+            return self._analyze_historical_topics(history)
+        if section == 'emotional_arc':
+            return self._analyze_emotional_arc(stats)
+        if section == 'conversation_rhythm':
+            return self._analyze_conversation_rhythm(history, stats)
+        if section == 'unfinished_threads':
+            return self._find_unfinished_threads(history)
+        if section == 'user_patterns':
+            return self._analyze_user_patterns(history, user_context)
+        raise KeyError(section)
     
     def _extract_topics(self, text):
         """Извлечение тем с весами"""
-        words = re.findall(r'\b[а-яё]{3,}\b', text.lower())
-        stop_words = {'этот', 'очень', 'которьій', 'когда', 'потом', 'тогда', 'вообще', 'значит'}
-        topics = {}
-        
-        for word in set(words) - stop_words:
-            if len(word) > 2:
-                weight = words.count(word) * 0.3
-                if word in text[:50]:
-                    weight += 0.2
-                topics[word] = min(1.0, weight)
-        
-        return dict(sorted(topics.items(), key=lambda x: x[1], reverse=True)[:5])
+        return topic_extractor.extract(text)
     
     def _analyze_historical_topics(self, history):
         """Анализ исторических тем"""
         historical_topics = {}
         for i, msg in enumerate(history[-20:]):
             if 'user' in msg:
-                topics = self._extract_topics(msg['user'])
+                topics = history_analysis(msg)['topics']
                 for topic, weight in topics.items():
                     if topic in historical_topics:
                         historical_topics[topic] += weight * (0.9 ** i)
@@ -207,45 +703,22 @@ class DeepContextAnalyzer:
         
         return dict(sorted(historical_topics.items(), key=lambda x: x[1], reverse=True)[:8])
     
-    def _analyze_emotional_arc(self, history):
+    def _analyze_emotional_arc(self, stats):
         """Анализ эмоциональной дуги беседы"""
-        emotions = []
-        for msg in history[-10:]:
-            if 'user' in msg:
-                emotional_score = self._calculate_emotional_score(msg['user'])
-                emotions.append(emotional_score)
-        
-        if len(emotions) > 2:
-            trend = np.polyfit(range(len(emotions)), emotions, 1)[0]
+        if stats.count > 2:
             return {
-                'current_mood': emotions[-1] if emotions else 0.5,
-                'trend': trend,
-                'volatility': np.std(emotions) if len(emotions) > 1 else 0
+                'current_mood': stats.last_score,
+                'trend': stats.slope,
+                'volatility': stats.volatility
             }
         return {'current_mood': 0.5, 'trend': 0, 'volatility': 0}
     
-    def _calculate_emotional_score(self, text):
-        """Вычисление эмоционального скора"""
-        positive = sum(1 for word in ['рад', 'счастлив', 'хорошо', 'отлично', 'люблю'] if word in text.lower())
-        negative = sum(1 for word in ['грустно', 'плохо', 'ненавижу', 'злой', 'обидно'] if word in text.lower())
-        
-        total = positive + negative
-        if total == 0:
-            return 0.5
-        return positive / total
-    
-    def _analyze_conversation_rhythm(self, history):
+    def _analyze_conversation_rhythm(self, history, stats):
         """Анализ ритма беседы"""
         if len(history) < 3:
             return {'pace': 'medium', 'initiative': 0.5}
         
-        response_times = []
-        for i in range(1, min(10, len(history))):
-            if 'timestamp' in history[i] and 'timestamp' in history[i-1]:
-                delta = (history[i]['timestamp'] - history[i-1]['timestamp']).total_seconds()
-                response_times.append(delta)
-        
-        avg_response = np.mean(response_times) if response_times else 60
+        avg_response = stats.mean_gap or 60
         if avg_response < 30:
             pace = 'fast'
         elif avg_response < 120:
@@ -263,11 +736,12 @@ class DeepContextAnalyzer:
         unfinished = []
         questions = []
         
-        for msg in history[-10:]:
+        start = max(0, len(history) - 10)
+        for index, msg in enumerate(history[start:], start):
             if 'user' in msg and '?' in msg['user']:
                 questions.append(msg['user'])
             if 'bot' in msg and '?' in msg['bot']:
-                next_msgs = history[history.index(msg)+1:]
+                next_msgs = history[index + 1:index + 3]
                 if not any('user' in m and '?' not in m.get('user', '') for m in next_msgs[:2]):
                     unfinished.append(msg['bot'])
         
@@ -290,110 +764,65 @@ class DeepContextAnalyzer:
         
         message_lengths = [len(msg.get('user', '')) for msg in history[-10:] if 'user' in msg]
         if message_lengths:
-            avg_length = np.mean(message_lengths)
-            patterns['response_style'] = 'detailed' if avg_length > 50 else 'concise'
-        
-        return patterns
-        
-        questions = sum(1 for msg in history[-10:] if 'user' in msg and '?' in msg['user'])
-        patterns['question_frequency'] = questions / min(10, len(history))
-        
-        message_lengths = [len(msg.get('user', '')) for msg in history[-10:] if 'user' in msg]
-        if message_lengths:
-            avg_length = np.mean(message_lengths)
+            avg_length = sum(message_lengths) / len(message_lengths)
             patterns['response_style'] = 'detailed' if avg_length > 50 else 'concise'
         
         return patterns
-   
-    def _format_memory_reference(self, topic, days_ago):
-        """Форматирование ссылки на воспоминание"""
-        if days_ago == 0:
-            time_key = 'today'
-        elif days_ago <= 3:
-            time_key = 'recent'
-        else:
-            time_key = 'past'
-        
-        memory_type = random.choice(['time_based', 'topic_based', 'emotional'])
-        intensity = random.choice(['strong', 'medium', 'weak'])
-        
-        template = self.associative_triggers[memory_type].get(
-            intensity, 
-            self.associative_triggers[memory_type]['medium']
-        )
-        
-        return template.format(topic)
 
-    def _detect_emotion(self, text, triggers):
-        """Обнаружение эмоции"""
-        score = 0
-        for trigger in triggers:
-            if trigger in text:
-                score += 1
-        return min(1.0, score * 0.3)
+# Секции глубокого контекста, которые читает промпт
+PROMPT_CONTEXT_SECTIONS = ('historical_topics',)
+
+# Секции, которые сохраняются в conversation_context (их читают план ответа,
+# теги сообщения и команды /context и /memory)
+PERSISTED_CONTEXT_SECTIONS = ('current_topics', 'historical_topics', 'emotional_arc',
+                              'conversation_rhythm', 'user_patterns')
+
+class DeepContext(Mapping):
+    """Глубокий контекст одного сообщения с ленивыми секциями.
     
-    def _analyze_emotional_trend(self, history):
-        """Анализ эмоционального тренда"""
-        if len(history) < 3:
-            return 'stable'
-        
-        recent_scores = []
-        for msg in history[-5:]:
-            if 'user' in msg:
-                score = self._calculate_emotional_score(msg['user'])
-                recent_scores.append(score)
-        
-        if len(recent_scores) > 2:
-            trend = np.polyfit(range(len(recent_scores)), recent_scores, 1)[0]
-            if abs(trend) > 0.1:
-                return 'improving' if trend > 0 else 'worsening'
-        return 'stable'
+    Секция вычисляется при первом обращении и запоминается, поэтому
+    секции, которые никто не читает, ничего не стоят.
+    """
     
-    def _calculate_emotional_score(self, text):
-        """Вычисление эмоционального скора"""
-        positive = sum(1 for word in ['рад', 'счастлив', 'хорошо', 'отлично'] if word in text.lower())
-        negative = sum(1 for word in ['грустно', 'плохо', 'ненавижу', 'злой'] if word in text.lower())
-        
-        total = positive + negative + 0.001
-        return positive / total
+    SECTIONS = ('current_topics', 'historical_topics', 'emotional_arc',
+                'conversation_rhythm', 'unfinished_threads', 'user_patterns')
     
-    def generate_empathic_response(self, emotional_state, response):
-        """Генерация эмпатичного ответа"""
-        dominant = emotional_state['dominant_emotion']
-        intensity = emotional_state['intensity']
-        
-        if intensity > 0.3:
-            emotional_reaction = self._get_emotional_reaction(dominant, intensity)
-            if random.random() < 0.6:
-                response = f"{emotional_reaction} {response}"
-            
-            if random.random() < 0.4:
-                empathic_phrase = self._get_empathic_phrase(dominant, intensity)
-                response = f"{response} {empathic_phrase}"
-        
-        return response
+    def __init__(self, analyzer, message, history, user_context, stats):
+        self._analyzer = analyzer
+        self._inputs = (message, history, user_context, stats)
+        self._sections = {}
     
-    def _get_emotional_reaction(self, emotion, intensity):
-        """Получение эмоциональной реакции"""
-        reactions = {
-            'joy': ['😊', '🎉', '✨', '🥳'],
-            'sadness': ['😔', '🤗', '❤️', '💔'],
-            'anger': ['😠', '😤', '💢', '⚡'],
-            'excitement': ['😃', '🚀', '🌟', '🔥'],
-            'confusion': ['🤔', '😕', '🧐', '💭']
-        }
-        return random.choice(reactions.get(emotion, ['🙂']))
+    def __getitem__(self, section):
+        if section not in self._sections:
+            if section not in self.SECTIONS:
+                raise KeyError(section)
+            self._sections[section] = self._analyzer.compute_section(section, *self._inputs)
+        return self._sections[section]
     
-    def _get_empathic_phrase(self, emotion, intensity):
-        """Получение эмпатичной фразы"""
-        phrases = {
-            'joy': ['Я рад за тебя!', 'Это прекрасно!', 'Как здорово!'],
-            'sadness': ['Понимаю тебя...', 'Мне жаль...', 'Держись!'],
-            'anger': ['Понимаю твои чувства', 'Это действительно неприятно'],
-            'excitement': ['Здорово!', 'Восхитительно!', 'Я разделяю твой восторг!'],
-            'confusion': ['Понимаю твоё замешательство', 'Давай разберемся вместе']
-        }
-        return random.choice(phrases.get(emotion, ['Понимаю...']))
+    def __iter__(self):
+        return iter(self.SECTIONS)
+    
+    def __len__(self):
+        return len(self.SECTIONS)
+    
+    def compute(self, sections):
+        """Заблаговременное вычисление секций (например, в пуле анализа)"""
+        for section in sections:
+            self[section]
+        return self
+    
+    def computed(self) -> Dict[str, Any]:
+        """Уже вычисленные секции"""
+        return dict(self._sections)
+    
+    def __getstate__(self):
+        # Анализатор не передается между процессами, используется глобальный
+        return {'inputs': self._inputs, 'sections': self._sections}
+    
+    def __setstate__(self, state):
+        self._analyzer = context_analyzer
+        self._inputs = state['inputs']
+        self._sections = state['sections']
 
 class HumanConversationSimulator:
     """Симулятор человеческой беседы"""
@@ -515,8 +944,12 @@ class HumanConversationSimulator:
             logger.error(f"Ошибка вычисления времени печатания: {e}")
             return len(message) * 0.03
     
-    async def simulate_human_response(self, message, context, history):
-        """Симуляция человеческого ответа"""
+    def plan_human_response(self, message, context, history):
+        """План человеческого ответа: стиль и бюджет времени на обдумывание и печать.
+        
+        Сам бюджет не выжидается здесь: генерация стартует сразу, а
+        ответ показывается не раньше, чем истечет delay.
+        """
         try:
             deep_context = context.get('deep_context', {}) or {}
             
@@ -524,17 +957,18 @@ class HumanConversationSimulator:
             typing_profile = self._select_typing_profile(deep_context)
             
             thinking_time = self._calculate_thinking_time(message, deep_context, history)
-            if thinking_time > 0.5:
-                await asyncio.sleep(min(thinking_time, 5.0))
-            
             typing_time = self._calculate_typing_time(message, typing_profile, context)
-            await asyncio.sleep(min(typing_time, 3.0))
+            
+            delay = min(typing_time, 3.0)
+            if thinking_time > 0.5:
+                delay += min(thinking_time, 5.0)
             
             return {
                 'thinking_time': thinking_time,
                 'typing_time': typing_time,
                 'conversation_style': conversation_style,
-                'typing_profile': typing_profile
+                'typing_profile': typing_profile,
+                'delay': delay
             }
             
         except Exception as e:
@@ -543,9 +977,270 @@ class HumanConversationSimulator:
                 'thinking_time': 1.0,
                 'typing_time': len(message) * 0.03,
                 'conversation_style': 'balanced',
-                'typing_profile': 'normal'
+                'typing_profile': 'normal',
+                'delay': 1.0
             }
 
+class HashingVectorizer:
+    """Векторизация без обучения и сети: хешированные символьные n-граммы.
+    
+    Каждое слово (кроме стоп-слов) дополняется пробелами по краям и режется
+    на n-граммы. N-грамма попадает в координату crc32 % dim со знаком из
+    старшего бита хеша. Общие n-граммы сближают формы одного слова
+    ("музыка" / "музыку"). Вектор нормирован, поэтому скалярное
+    произведение равно косинусной близости.
+    """
+    
+    TOKEN_PATTERN = re.compile(r'[а-яёa-z0-9]{3,}')
+    
+    def __init__(self, dim=MEMORY_VECTOR_DIM, ngram_range=(3, 4), stop_words=None):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.stop_words = stop_words if stop_words is not None else topic_extractor.stop_words
+    
+    def transform(self, text: str) -> np.ndarray:
+        """Вектор float32 длины dim (нулевой, если в тексте нет значимых слов)"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        low, high = self.ngram_range
+        for word in self.TOKEN_PATTERN.findall(text.lower()):
+            if word in self.stop_words:
+                continue
+            padded = f' {word} '
+            for n in range(low, high + 1):
+                for start in range(len(padded) - n + 1):
+                    code = zlib.crc32(padded[start:start + n].encode())
+                    vector[code % self.dim] += 1.0 if code & 0x80000000 else -1.0
+        
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector
+
+class UserVectors:
+    """Векторы сообщений одного пользователя.
+    
+    На диске - два файла, в которые только дописывают: <path>.vec (float32,
+    строка на сообщение) и <path>.ids (int64 id сообщений). Небольшие
+    индексы держатся в памяти в растущем буфере, большие (от mmap_rows
+    строк) отображаются в память через np.memmap.
+    
+    lock - блокировка пользователя из VectorMemory: под ней же идет
+    дозапись файлов, когда индекс не загружен.
+    """
+    
+    def __init__(self, path: str, dim=MEMORY_VECTOR_DIM, mmap_rows=MEMORY_VECTOR_MMAP_ROWS, lock=None):
+        self.path = path
+        self.vec_path = path + '.vec'
+        self.ids_path = path + '.ids'
+        self.dim = dim
+        self.mmap_rows = mmap_rows
+        self._lock = lock or threading.RLock()
+        self._load()
+    
+    @staticmethod
+    def _rows(path: str, dim: int) -> int:
+        """Число целых строк, записанных в оба файла"""
+        if not (os.path.exists(path + '.vec') and os.path.exists(path + '.ids')):
+            return 0
+        return min(os.path.getsize(path + '.vec') // (4 * dim), os.path.getsize(path + '.ids') // 8)
+    
+    @staticmethod
+    def repair(path: str, dim=MEMORY_VECTOR_DIM):
+        """Отрезание недописанного после сбоя хвоста, чтобы файлы не разошлись.
+        
+        Только при запуске, пока никто не дописывает файлы.
+        """
+        rows = UserVectors._rows(path, dim)
+        for suffix, row_bytes in (('.vec', 4 * dim), ('.ids', 8)):
+            if os.path.exists(path + suffix) and os.path.getsize(path + suffix) != rows * row_bytes:
+                os.truncate(path + suffix, rows * row_bytes)
+    
+    def _load(self):
+        # Читаются только целые строки; файлы здесь не меняются
+        rows = self._rows(self.path, self.dim)
+        
+        self.size = rows
+        self.mapped = rows >= self.mmap_rows
+        self._stale = False
+        
+        if self.mapped:
+            self._vectors = np.memmap(self.vec_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+            self._ids = np.memmap(self.ids_path, dtype=np.int64, mode='r', shape=(rows,))
+            return
+        
+        capacity = max(16, rows + rows // 4)
+        self._vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        self._ids = np.empty(capacity, dtype=np.int64)
+        if rows:
+            self._vectors[:rows] = np.fromfile(self.vec_path, dtype=np.float32, count=rows * self.dim).reshape(rows, self.dim)
+            self._ids[:rows] = np.fromfile(self.ids_path, dtype=np.int64, count=rows)
+    
+    @staticmethod
+    def append_files(path: str, ids: np.ndarray, vectors: np.ndarray):
+        """Дозапись векторов в файлы без загрузки индекса"""
+        with open(path + '.vec', 'ab') as f:
+            f.write(vectors.astype(np.float32, copy=False).tobytes())
+        with open(path + '.ids', 'ab') as f:
+            f.write(ids.astype(np.int64, copy=False).tobytes())
+    
+    def append(self, ids: np.ndarray, vectors: np.ndarray):
+        """Добавление векторов на диск и в загруженный индекс"""
+        with self._lock:
+            self.append_files(self.path, ids, vectors)
+            size = self.size + len(ids)
+            
+            if self.mapped or size >= self.mmap_rows:
+                # Отображение перечитывается при следующем поиске
+                self._stale = True
+            else:
+                if size > len(self._ids):
+                    capacity = size * 2
+                    grown_vectors = np.empty((capacity, self.dim), dtype=np.float32)
+                    grown_vectors[:self.size] = self._vectors[:self.size]
+                    grown_ids = np.empty(capacity, dtype=np.int64)
+                    grown_ids[:self.size] = self._ids[:self.size]
+                    self._vectors, self._ids = grown_vectors, grown_ids
+                self._vectors[self.size:size] = vectors
+                self._ids[self.size:size] = ids
+            self.size = size
+    
+    @property
+    def nbytes(self) -> int:
+        """Память процесса под индекс; отображенные файлы живут в страничном кэше ОС"""
+        if self.mapped:
+            return 0
+        return self._vectors.nbytes + self._ids.nbytes
+    
+    def search(self, query: np.ndarray, k: int) -> List[tuple]:
+        """Top-k (id сообщения, косинусная близость) по убыванию близости"""
+        with self._lock:
+            if self._stale:
+                self._load()
+            vectors = self._vectors[:self.size]
+            ids = self._ids[:self.size]
+        
+        if not len(ids) or k <= 0:
+            return []
+        
+        scores = vectors @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+class VectorMemory:
+    """Векторная память сообщений всех пользователей с LRU загруженных индексов.
+    
+    LRU ограничен и числом пользователей, и объемом памяти под индексы в
+    буферах (max_mb); отображенные через memmap индексы в объем не входят.
+    """
+    
+    def __init__(self, directory=MEMORY_VECTOR_DIR, dim=MEMORY_VECTOR_DIM,
+                 mmap_rows=MEMORY_VECTOR_MMAP_ROWS, max_users=MEMORY_VECTOR_CACHE_USERS,
+                 max_mb=MEMORY_VECTOR_CACHE_MB):
+        self.directory = directory
+        self.dim = dim
+        self.mmap_rows = mmap_rows
+        self.max_users = max_users
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        # Дозапись и загрузка файлов одного пользователя идут под одной блокировкой
+        self._user_locks = [threading.RLock() for _ in range(64)]
+    
+    def _path(self, user_id: int) -> str:
+        return os.path.join(self.directory, str(user_id))
+    
+    def _user_lock(self, user_id: int) -> threading.RLock:
+        return self._user_locks[user_id % len(self._user_locks)]
+    
+    def _cached(self, user_id: int) -> Optional[UserVectors]:
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is not None:
+                self._users.move_to_end(user_id)
+            return index
+    
+    def _index(self, user_id: int) -> UserVectors:
+        with self._user_lock(user_id):
+            index = self._cached(user_id)
+            if index is not None:
+                return index
+            
+            index = UserVectors(self._path(user_id), self.dim, self.mmap_rows, self._user_lock(user_id))
+            with self._lock:
+                self._users[user_id] = index
+            self._evict()
+            return index
+    
+    def _evict(self):
+        """Вытеснение давно не использованных индексов сверх лимитов; последний остается"""
+        with self._lock:
+            loaded_bytes = sum(index.nbytes for index in self._users.values())
+            while len(self._users) > 1 and (len(self._users) > self.max_users or loaded_bytes > self.max_bytes):
+                _, index = self._users.popitem(last=False)
+                loaded_bytes -= index.nbytes
+    
+    def repair(self, owned=None):
+        """Восстановление согласованности файлов после сбоя, пока их никто не дописывает.
+        
+        owned(user_id) ограничивает починку пользователями одного воркера.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if not name.endswith('.ids'):
+                continue
+            user = name[:-len('.ids')]
+            if owned is not None and not (user.lstrip('-').isdigit() and owned(int(user))):
+                continue
+            UserVectors.repair(os.path.join(self.directory, user), self.dim)
+    
+    def add_many(self, rows: List[tuple]):
+        """Добавление строк (user_id, message_id, вектор)"""
+        by_user = defaultdict(list)
+        for user_id, message_id, vector in rows:
+            by_user[user_id].append((message_id, vector))
+        
+        os.makedirs(self.directory, exist_ok=True)
+        for user_id, items in by_user.items():
+            ids = np.array([message_id for message_id, _ in items], dtype=np.int64)
+            vectors = np.vstack([vector for _, vector in items])
+            with self._user_lock(user_id):
+                index = self._cached(user_id)
+                if index is not None:
+                    index.append(ids, vectors)
+                else:
+                    UserVectors.append_files(self._path(user_id), ids, vectors)
+        # Буферы загруженных индексов могли вырасти
+        self._evict()
+    
+    def search(self, user_id: int, query: np.ndarray, k=MEMORY_VECTOR_TOP_K) -> List[tuple]:
+        """Top-k похожих сообщений пользователя: [(id сообщения, близость)]"""
+        if not os.path.exists(self._path(user_id) + '.ids'):
+            return []
+        return self._index(user_id).search(query, k)
+    
+    def drop(self, user_id: int):
+        """Удаление векторов пользователя (перед перестроением)"""
+        with self._user_lock(user_id):
+            with self._lock:
+                self._users.pop(user_id, None)
+            for suffix in ('.vec', '.ids'):
+                if os.path.exists(self._path(user_id) + suffix):
+                    os.remove(self._path(user_id) + suffix)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Загруженные индексы и число строк в них"""
+        with self._lock:
+            indexes = list(self._users.values())
+        return {
+            'loaded_users': len(indexes),
+            'mapped_users': sum(1 for index in indexes if index.mapped),
+            'loaded_mb': round(sum(index.nbytes for index in indexes) / 1024 / 1024, 1),
+            'loaded_rows': sum(index.size for index in indexes)
+        }
+
 class MemorySystem:
     """Система памяти и воспоминаний"""
     
@@ -573,38 +1268,49 @@ class MemorySystem:
             }
         }
     
-    def create_contextual_memory(self, current_message, history, user_context):
-        """Создание контекстных воспоминаний"""
-        if len(history) < 3:
+    async def create_contextual_memory(self, current_message, user_context):
+        """Создание контекстных воспоминаний по всей истории пользователя"""
+        if (user_context.get('messages_count') or 0) < 3:
             return None
         
-        current_topics = set(DeepContextAnalyzer()._extract_topics(current_message).keys())
-        memory_candidates = []
+        current_topics = list(analyze_message(current_message)['topics'])
+        query = memory_vectorizer.transform(current_message)
+        if not current_topics and not query.any():
+            return None
         
-        for i, past_msg in enumerate(history[-20:]):
-            if 'user' in past_msg:
-                past_topics = set(DeepContextAnalyzer()._extract_topics(past_msg['user']).keys())
-                common_topics = current_topics.intersection(past_topics)
-                
-                if common_topics:
-                    days_ago = (datetime.now() - past_msg.get('timestamp', datetime.now())).days
-                    memory_candidates.append({
-                        'topics': common_topics,
-                        'recency': days_ago,
-                        'message': past_msg['user'],
-                        'index': i
-                    })
+        # Незаписанные обмены должны попасть в индексы до поиска
+        user_id = user_context['user_id']
+        if write_queue.has_pending(user_id):
+            await write_queue.flush()
+        
+        candidates = await user_database.read(
+            _recall_memories, user_id, current_topics, query, MEMORY_RECALL_PER_TOPIC
+        )
+        
+        now = datetime.utcnow()
+        memory_candidates = []
+        for candidate in candidates.values():
+            # Общая тема, а для найденных по близости - главная тема того сообщения
+            topics = sorted(candidate['topics']) or candidate['message_topics'][:1]
+            if topics:
+                memory_candidates.append({
+                    'topics': topics,
+                    'overlap': len(candidate['topics']),
+                    'similarity': candidate['similarity'],
+                    'recency': max(0, (now - candidate['timestamp']).days)
+                })
         
         if not memory_candidates:
             return None
         
         best_memory = max(memory_candidates, key=lambda x: (
-            len(x['topics']) * 0.5 + 
+            x['overlap'] * 0.5 + 
+            x['similarity'] * 0.5 +
             (1 / (x['recency'] + 1)) * 0.3 +
             random.random() * 0.2
         ))
         
-        topic = random.choice(list(best_memory['topics']))
+        topic = random.choice(best_memory['topics'])
         return self._format_memory_reference(topic, best_memory['recency'])
     
     def _format_memory_reference(self, topic, days_ago):
@@ -619,10 +1325,13 @@ class MemorySystem:
         memory_type = random.choice(['time_based', 'topic_based', 'emotional'])
         intensity = random.choice(['strong', 'medium', 'weak'])
         
-        template = self.associative_triggers[memory_type].get(
-            intensity, 
-            self.associative_triggers[memory_type]['medium']
-        )
+        # У каждого типа свои ключи шаблонов
+        template_key = {
+            'time_based': time_key,
+            'topic_based': intensity,
+            'emotional': 'neutral'
+        }[memory_type]
+        template = self.associative_triggers[memory_type][template_key]
         
         return template.format(topic)
 
@@ -632,6 +1341,13 @@ class EmotionalIntelligence:
     def __init__(self):
         self.empathy_responses = self._create_empathy_responses()
     
+    def score_emotions(self, hits):
+        """Оценки эмоций по совпадениям лексиконов"""
+        return {
+            emotion: self._detect_emotion(hits, emotion)
+            for emotion in ('joy', 'sadness', 'anger', 'excitement', 'confusion')
+        }
+    
     def _create_empathy_responses(self):
         """Создание эмпатичных ответов"""
         return {
@@ -642,19 +1358,11 @@ class EmotionalIntelligence:
             'confusion': ['Понимаю твоё замешательство', 'Давай разберемся вместе']
         }
        
-    def analyze_emotional_state(self, message, history):
+    def analyze_emotional_state(self, message, stats):
         """Анализ эмоционального состояния"""
-        text = message.lower()
-        
-        emotions = {
-            'joy': self._detect_emotion(text, ['рад', 'счастлив', 'ура', 'класс', 'супер']),
-            'sadness': self._detect_emotion(text, ['грустно', 'печально', 'плохо', 'тяжело']),
-            'anger': self._detect_emotion(text, ['злой', 'сердит', 'бесит', 'ненавижу']),
-            'excitement': self._detect_emotion(text, ['!', '!!', '!!!', 'вау', 'ого']),
-            'confusion': self._detect_emotion(text, ['?', '??', '???', 'не понимаю', 'запутался'])
-        }
+        emotions = dict(analyze_message(message)['emotions'])
         
-        emotional_trend = self._analyze_emotional_trend(history)
+        emotional_trend = self._analyze_emotional_trend(stats)
         
         return {
             'current_emotions': emotions,
@@ -663,35 +1371,21 @@ class EmotionalIntelligence:
             'intensity': max(emotions.values()) if emotions else 0
         }
     
-    def _detect_emotion(self, text, triggers):
-        """Обнаружение эмоции"""
-        score = 0
-        for trigger in triggers:
-            if trigger in text:
-                score += 1
-        return min(1.0, score * 0.3)
+    def _detect_emotion(self, hits, emotion):
+        """Обнаружение эмоции: 0.3 за каждый найденный триггер"""
+        return min(1.0, hits.get(emotion, 0) * 0.3)
     
-    def _analyze_emotional_trend(self, history):
+    def _analyze_emotional_trend(self, stats):
         """Анализ эмоционального тренда"""
-        if len(history) < 3:
-            return 'stable'
-        
-        recent_scores = []
-        for msg in history[-5:]:
-            if 'user' in msg:
-                score = self._calculate_emotional_score(msg['user'])
-                recent_scores.append(score)
-        
-        if len(recent_scores) > 2:
-            trend = np.polyfit(range(len(recent_scores)), recent_scores, 1)[0]
-            if abs(trend) > 0.1:
-                return 'improving' if trend > 0 else 'worsening'
+        trend = stats.slope
+        if abs(trend) > 0.1:
+            return 'improving' if trend > 0 else 'worsening'
         return 'stable'
     
-    def _calculate_emotional_score(self, text):
-        """Вычисление эмоционального скора"""
-        positive = sum(1 for word in ['рад', 'счастлив', 'хорошо', 'отлично'] if word in text.lower())
-        negative = sum(1 for word in ['грустно', 'плохо', 'ненавижу', 'злой'] if word in text.lower())
+    def _calculate_emotional_score(self, hits):
+        """Вычисление эмоционального скора по совпадениям лексиконов"""
+        positive = hits.get('positive', 0)
+        negative = hits.get('negative', 0)
         
         total = positive + negative + 0.001
         return positive / total
@@ -740,89 +1434,176 @@ context_analyzer = DeepContextAnalyzer()
 conversation_simulator = HumanConversationSimulator()
 memory_system = MemorySystem()
 emotional_intelligence = EmotionalIntelligence()
+memory_vectorizer = HashingVectorizer()
+vector_memory = VectorMemory()
 
-def extract_personal_info(message: str) -> Dict[str, str]:
-    """Улучшенное извлечение персональной информации"""
-    info = {}
+# Функции стадии анализа: только данные на входе и выходе, чтобы их можно
+# было передать в другой процесс
+def _deep_context_stage(message, history, user_context, stats):
+    # Секции, которые точно понадобятся ходу, считаются здесь же, вне цикла событий
+    deep_context = context_analyzer.extract_deep_context(message, history, user_context, stats)
+    return deep_context.compute(PROMPT_CONTEXT_SECTIONS + PERSISTED_CONTEXT_SECTIONS)
+
+def _emotional_state_stage(message, stats):
+    return emotional_intelligence.analyze_emotional_state(message, stats)
+
+def _ignore_interrupts():
+    """Инициализация процесса пула: остановкой управляет основной процесс"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+class AnalysisStage:
+    """Анализ сообщения вне цикла событий.
     
-    # Поиск имени с улучшенными паттернами
-    name_patterns = [
-        r'меня зовут (\w+)', r'я (\w+)', r'зовут (\w+)', 
-        r'мое имя (\w+)', r'имя (\w+)', r'звать (\w+)'
-    ]
+    Глубокий контекст и эмоциональное состояние считаются параллельно в
+    пуле потоков или процессов, пока цикл событий продолжает опрашивать
+    Telegram и отвечать другим пользователям. Поиск воспоминания - запрос
+    к индексу тем в базе, он идет одновременно с ними.
+    """
     
-    for pattern in name_patterns:
-        match = re.search(pattern, message.lower())
-        if match:
-            name = match.group(1).capitalize()
-            # Проверка на валидность имени
-            if len(name) > 1 and name.isalpha():
-                info['name'] = name
-                break
+    def __init__(self, kind=ANALYSIS_POOL, workers=ANALYSIS_WORKERS):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"ANALYSIS_POOL должен быть thread или process, а не {kind!r}")
+        self.kind = kind
+        self.workers = workers
+        self._executor = None
+        self._stats = {'runs': 0, 'failures': 0, 'total_time': 0.0, 'max_time': 0.0}
     
-    # Поиск возраста
-    age_patterns = [
-        r'мне (\d+) лет', r'мне (\d+) год', r'возраст (\d+)', 
-        r'(\d+) лет', r'(\d+) год'
-    ]
+    def _start(self):
+        """Создание пула (лениво, чтобы стадию можно было запустить повторно после close)"""
+        if self._executor is None:
+            if self.kind == 'process':
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_ignore_interrupts
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='analysis')
+        return self._executor
     
-    for pattern in age_patterns:
-        match = re.search(pattern, message.lower())
-        if match:
-            age = match.group(1)
-            if age.isdigit() and 1 <= int(age) <= 120:
-                info['age'] = age
-                break
+    async def analyze(self, message: str, history: List[Dict[str, Any]],
+                      user_context: Dict[str, Any], stats: 'ConversationStats'):
+        """(deep_context, emotional_state, memory_reference) для сообщения"""
+        loop = asyncio.get_running_loop()
+        executor = self._start()
+        started = time.monotonic()
+        try:
+            return await asyncio.gather(
+                loop.run_in_executor(executor, _deep_context_stage, message, history, user_context, stats),
+                loop.run_in_executor(executor, _emotional_state_stage, message, stats),
+                memory_system.create_contextual_memory(message, user_context)
+            )
+        except Exception:
+            self._stats['failures'] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self._stats['runs'] += 1
+            self._stats['total_time'] += elapsed
+            self._stats['max_time'] = max(self._stats['max_time'], elapsed)
     
-    # Поиск увлечений
-    interest_patterns = [
-        r'люблю ([^.!?]+)', r'нравится ([^.!?]+)', r'увлекаюсь ([^.!?]+)',
-        r'занимаюсь ([^.!?]+)', r'хобби ([^.!?]+)', r'интересуюсь ([^.!?]+)'
-    ]
+    def close(self):
+        """Остановка пула"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Число запусков и время стадии"""
+        runs = self._stats['runs']
+        return {
+            'pool': self.kind,
+            'workers': self.workers,
+            'runs': runs,
+            'failures': self._stats['failures'],
+            'avg_ms': round(self._stats['total_time'] / runs * 1000, 1) if runs else 0.0,
+            'max_ms': round(self._stats['max_time'] * 1000, 1)
+        }
+
+analysis_stage = AnalysisStage()
+
+@lru_cache(maxsize=ANALYSIS_CACHE_SIZE)
+def analyze_message(text: str) -> Dict[str, Any]:
+    """Анализ сообщения, выполняемый один раз для всех анализаторов.
+    
+    Результат общий (кэшируется по тексту), изменять его нельзя.
+    """
+    lowered = text.lower()
+    tokens, topics = topic_extractor.extract_with_tokens(lowered)
+    hits = lexicon_matcher.count(lowered)
+    return {
+        'tokens': tokens,
+        'topics': topics,
+        'lexicon_hits': hits,
+        'emotional_score': emotional_intelligence._calculate_emotional_score(hits),
+        'emotions': emotional_intelligence.score_emotions(hits)
+    }
+
+def history_analysis(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """Анализ сообщения из истории: сохраненный вместе с ним или вычисленный один раз"""
+    analysis = msg.get('analysis')
+    if analysis is None:
+        analysis = analyze_message(msg['user'])
+        msg['analysis'] = analysis
+    return analysis
+
+def persisted_analysis(analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """Часть анализа, которая хранится в messages.analysis (без токенов и совпадений)"""
+    return {key: value for key, value in analysis.items() if key not in ('tokens', 'lexicon_hits')}
+
+def extract_personal_info(message: str) -> Dict[str, str]:
+    """Улучшенное извлечение персональной информации"""
+    info = {}
+    
+    # Все шаблоны проверяются за один проход, приоритет - порядок в FACT_PATTERNS
+    found = fact_matcher.first_matches(message.lower())
     
-    for pattern in interest_patterns:
-        match = re.search(pattern, message.lower())
-        if match:
-            interests = match.group(1).strip()
+    for index, (fact_type, _) in enumerate(FACT_PATTERNS):
+        if fact_type in info or index not in found:
+            continue
+        value = found[index]
+        
+        if fact_type == 'name':
+            # Проверка на валидность имени
+            name = value.capitalize()
+            if len(name) > 1 and name.isalpha():
+                info['name'] = name
+        elif fact_type == 'age':
+            if value.isdigit() and 1 <= int(value) <= 120:
+                info['age'] = value
+        elif fact_type == 'interests':
+            interests = value.strip()
             if len(interests) > 3:
                 info['interests'] = interests
-                break
     
     return info
 
-def save_user_fact(user_id: int, fact_type: str, fact_value: str, confidence: float = 1.0):
+def _store_user_fact(conn: sqlite3.Connection, user_id: int, fact_type: str, fact_value: str,
+                     confidence: float):
+    conn.execute("""
+        INSERT OR REPLACE INTO user_facts 
+        (user_id, fact_type, fact_value, confidence, last_updated)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    """, (user_id, fact_type, fact_value, confidence))
+
+async def save_user_fact(user_id: int, fact_type: str, fact_value: str, confidence: float = 1.0):
     """Сохранение факта с уверенностью"""
     try:
-        conn = sqlite3.connect("bot_users.db")
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT OR REPLACE INTO user_facts 
-            (user_id, fact_type, fact_value, confidence, last_updated)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (user_id, fact_type, fact_value, confidence))
-        
-        conn.commit()
-        conn.close()
+        await user_database.write(_store_user_fact, user_id, fact_type, fact_value, confidence)
+        conversation_context.apply_fact(user_id, fact_type, fact_value)
         
     except Exception as e:
         logger.error(f"Ошибка сохранения факта пользователя {user_id}: {e}")
 
-def get_user_fact(user_id: int, fact_type: str) -> Optional[str]:
+def _load_user_fact(conn: sqlite3.Connection, user_id: int, fact_type: str) -> Optional[tuple]:
+    cursor = conn.execute(HOT_QUERIES['user_fact'], (user_id, fact_type))
+    return cursor.fetchone()
+
+async def get_user_fact(user_id: int, fact_type: str) -> Optional[str]:
     """Получение факта о пользователе"""
     try:
-        conn = sqlite3.connect("bot_users.db")
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT fact_value, confidence FROM user_facts 
-            WHERE user_id = ? AND fact_type = ? 
-            ORDER BY confidence DESC, last_updated DESC 
-            LIMIT 1
-        """, (user_id, fact_type))
-        
-        result = cursor.fetchone()
-        conn.close()
+        result = await user_database.read(_load_user_fact, user_id, fact_type)
         
         if result and result[1] > 0.5:  # Минимальная уверенность
             return result[0]
@@ -832,40 +1613,35 @@ def get_user_fact(user_id: int, fact_type: str) -> Optional[str]:
         logger.error(f"Ошибка получения факта пользователя {user_id}: {e}")
         return None
 
-def handle_personal_questions(message: str, user_context: Dict[str, Any]) -> Optional[str]:
+async def handle_personal_questions(message: str, user_context: Dict[str, Any]) -> Optional[str]:
     """Обработка личных вопросов"""
-    text = message.lower()
+    hits = analyze_message(message)['lexicon_hits']
     user_id = user_context['user_id']
     
     # Вопросы о имени бота
-    name_questions = ['как тебя зовут', 'твое имя', 'как зовут']
-    if any(q in text for q in name_questions):
+    if hits.get('ask_bot_name'):
         bot_personality = user_context.get('bot_personality', {})
         return f"Меня зовут {bot_personality.get('name', 'друг')} 😊"
     
     # Вопросы о возрасте бота
-    age_questions = ['сколько тебе лет', 'твой возраст', 'какой возраст']
-    if any(q in text for q in age_questions):
+    if hits.get('ask_bot_age'):
         return "Я всегда молод душой! Возраст - это всего лишь цифра, главное - интересное общение 🤗"
     
     # Вопросы о поле бота
-    gender_questions = ['ты парень', 'ты девушка', 'ты мужчина', 'ты женщина', 'ты мужик']
-    if any(q in text for q in gender_questions):
+    if hits.get('ask_bot_gender'):
         return "Я здесь, чтобы быть хорошим собеседником, независимо от пола 😊"
     
     # Вопросы о имени пользователя
-    user_name_questions = ['как меня зовут', 'мое имя', 'меня звать']
-    if any(q in text for q in user_name_questions):
-        user_name = get_user_fact(user_id, 'name')
+    if hits.get('ask_user_name'):
+        user_name = await get_user_fact(user_id, 'name')
         if user_name:
             return f"Тебя зовут {user_name}! Как можно забыть такое красивое имя? 😄"
         else:
             return "Ты еще не сказал мне своего имени. Как тебя зовут? 🤔"
     
     # Вопросы о возрасте пользователя
-    user_age_questions = ['сколько мне лет', 'мой возраст']
-    if any(q in text for q in user_age_questions):
-        user_age = get_user_fact(user_id, 'age')
+    if hits.get('ask_user_age'):
+        user_age = await get_user_fact(user_id, 'age')
         if user_age:
             return f"Тебе {user_age} лет! Отличный возраст для новых свершений! 🌟"
         else:
@@ -873,179 +1649,326 @@ def handle_personal_questions(message: str, user_context: Dict[str, Any]) -> Opt
     
     return None
 
-def get_user_context(user_id: int) -> Dict[str, Any]:
+def _register_user(conn: sqlite3.Connection, user_id: int):
+    conn.execute("""
+        INSERT OR IGNORE INTO users (user_id, created_at, last_interaction) 
+        VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    """, (user_id,))
+
+def _load_user_context(conn: sqlite3.Connection, user_id: int) -> Optional[Dict[str, Any]]:
+    """Чтение контекста пользователя, None если пользователь еще не зарегистрирован"""
+    cursor = conn.cursor()
+    
+    cursor.execute(HOT_QUERIES['user'], (user_id,))
+    user_data = cursor.fetchone()
+    
+    if not user_data:
+        return None
+    
+    cursor.execute(HOT_QUERIES['recent_messages'], (user_id,))
+    messages = cursor.fetchall()
+    
+    cursor.execute(HOT_QUERIES['conversation_context'], (user_id,))
+    context_data = cursor.fetchone()
+    
+    cursor.execute(HOT_QUERIES['bot_personality'], (user_id,))
+    personality_data = cursor.fetchone()
+    
+    cursor.execute(HOT_QUERIES['user_facts'], (user_id,))
+    user_facts_data = cursor.fetchall()
+    
+    cursor.execute(HOT_QUERIES['conversation_summary'], (user_id,))
+    summary_data = cursor.fetchone()
+    
+    context = {
+        'user_id': user_id,
+        'history': [],
+        'messages_count': 0,
+        'last_interaction': None,
+        'user_facts': {}
+    }
+    
+    context['messages_count'] = user_data[0] or 0
+    context['last_interaction'] = user_data[1]
+    
+    for msg in messages:
+        context['history'].append({
+            'user': msg[0],
+            'bot': msg[1],
+            'timestamp': datetime.fromisoformat(msg[2]) if isinstance(msg[2], str) else msg[2],
+            'emotional_score': msg[3],
+            'topics': json.loads(msg[4]) if msg[4] else [],
+            'analysis': json.loads(msg[5]) if msg[5] else None
+        })
+    
+    if context_data:
+        try:
+            context['deep_context'] = {
+                'current_topics': json.loads(context_data[1]) if context_data[1] else {},
+                'historical_topics': json.loads(context_data[2]) if context_data[2] else {},
+                'emotional_arc': json.loads(context_data[3]) if context_data[3] else {},
+                'conversation_rhythm': json.loads(context_data[4]) if context_data[4] else {},
+                'user_patterns': json.loads(context_data[5]) if context_data[5] else {}
+            }
+        except json.JSONDecodeError:
+            context['deep_context'] = {}
+        
+        if context_data[9]:
+            context['conversation_stats'] = json.loads(context_data[9])
+    
+    if personality_data:
+        try:
+            context['bot_personality'] = json.loads(personality_data[1])
+        except json.JSONDecodeError:
+            context['bot_personality'] = None
+    
+    for fact_type, fact_value in user_facts_data:
+        context['user_facts'][fact_type] = fact_value
+    
+    if summary_data:
+        context['conversation_summary'] = summary_data[0]
+    
+    return context
+
+async def get_user_context(user_id: int) -> Dict[str, Any]:
     """Получение контекста пользователя из базы данных"""
     try:
-        conn = sqlite3.connect("bot_users.db")
-        cursor = conn.cursor()
+        context = conversation_context.get(user_id)
+        if context is not None:
+            return context
         
-        cursor.execute("SELECT COUNT(*) FROM users WHERE user_id = ?", (user_id,))
-        user_exists = cursor.fetchone()[0] > 0
+        token = conversation_context.begin_fill(user_id)
         
-        if not user_exists:
-            cursor.execute("""
-                INSERT INTO users (user_id, created_at, last_interaction) 
-                VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            """, (user_id,))
-            conn.commit()
-            conn.close()
-            return {'user_id': user_id, 'history': [], 'messages_count': 0, 'user_facts': {}}
+        # Незаписанные обмены должны быть видны при чтении
+        if write_queue.has_pending(user_id):
+            await write_queue.flush()
         
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user_data = cursor.fetchone()
+        context = await user_database.read(_load_user_context, user_id)
         
-        cursor.execute("""
-            SELECT message_text, bot_response, timestamp, emotional_score, topic_tags 
-            FROM messages 
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT 20
-        """, (user_id,))
-        messages = cursor.fetchall()
-        
-        cursor.execute("SELECT * FROM conversation_context WHERE user_id = ?", (user_id,))
-        context_data = cursor.fetchone()
-        
-        cursor.execute("SELECT * FROM bot_personality WHERE user_id = ?", (user_id,))
-        personality_data = cursor.fetchone()
-        
-        cursor.execute("SELECT fact_type, fact_value FROM user_facts WHERE user_id = ?", (user_id,))
-        user_facts_data = cursor.fetchall()
-        
-        conn.close()
-        
-        context = {
-            'user_id': user_id,
-            'history': [],
-            'messages_count': 0,
-            'last_interaction': None,
-            'user_facts': {}
-        }
-        
-        if user_data:
-            context['messages_count'] = user_data[6] if len(user_data) > 6 else 0
-            context['last_interaction'] = user_data[5] if len(user_data) > 5 else None
-        
-        for msg in messages:
-            context['history'].append({
-                'user': msg[0],
-                'bot': msg[1],
-                'timestamp': datetime.fromisoformat(msg[2]) if isinstance(msg[2], str) else msg[2],
-                'emotional_score': msg[3],
-                'topics': json.loads(msg[4]) if msg[4] else []
-            })
-        
-        if context_data:
-            try:
-                context['deep_context'] = {
-                    'current_topics': json.loads(context_data[1]) if context_data[1] else {},
-                    'historical_topics': json.loads(context_data[2]) if context_data[2] else {},
-                    'emotional_arc': json.loads(context_data[3]) if context_data[3] else {},
-                    'conversation_rhythm': json.loads(context_data[4]) if context_data[4] else {},
-                    'user_patterns': json.loads(context_data[5]) if context_data[5] else {},
-                    'unfinished_threads': json.loads(context_data[6]) if context_data[6] else {}
-                }
-            except json.JSONDecodeError:
-                context['deep_context'] = {}
-        
-        if personality_data:
-            try:
-                context['bot_personality'] = json.loads(personality_data[1])
-            except json.JSONDecodeError:
-                context['bot_personality'] = None
-        
-        for fact_type, fact_value in user_facts_data:
-            context['user_facts'][fact_type] = fact_value
+        if context is None:
+            await user_database.write(_register_user, user_id)
+            context = {'user_id': user_id, 'history': [], 'messages_count': 0,
+                       'last_interaction': None, 'user_facts': {}}
         
+        conversation_context.fill(user_id, token, context)
         return context
         
     except Exception as e:
         logger.error(f"Ошибка получения контекста пользователя {user_id}: {e}")
         return {'user_id': user_id, 'history': [], 'messages_count': 0, 'user_facts': {}}
 
-def save_complete_context(user_id: int, user_message: str, bot_response: str, 
-                         deep_context: Dict[str, Any], emotional_state: Dict[str, Any],
-                         response_metrics: Dict[str, Any], memory_reference: Optional[str] = None):
-    """Сохранение полного контекста беседы"""
-    try:
-        conn = sqlite3.connect("bot_users.db")
-        cursor = conn.cursor()
-        
-        context_hash = hashlib.md5(
-            f"{user_id}{user_message}{datetime.now().timestamp()}".encode()
-        ).hexdigest()
-        
-        topics = list(deep_context.get('current_topics', {}).keys())[:5]
-        
-        cursor.execute("""
-            INSERT OR IGNORE INTO users (user_id, created_at, last_interaction) 
-            VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        """, (user_id,))
-        
-        cursor.execute("""
-            UPDATE users SET last_interaction = CURRENT_TIMESTAMP WHERE user_id = ?
-        """, (user_id,))
-        
+def _store_exchanges(conn: sqlite3.Connection, exchanges: List[Dict[str, Any]],
+                     contexts: Dict[int, Dict[str, Any]]):
+    """Запись пачки обменов сообщениями одной транзакцией.
+    
+    Возвращает строки (user_id, id сообщения, вектор) для векторной памяти.
+    """
+    cursor = conn.cursor()
+    
+    user_ids = {exchange['user_id'] for exchange in exchanges} | set(contexts)
+    cursor.executemany("""
+        INSERT OR IGNORE INTO users (user_id, created_at, last_interaction) 
+        VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    """, [(user_id,) for user_id in user_ids])
+    
+    postings = []
+    vectors = []
+    stored = []
+    for exchange in exchanges:
+        # Повторно доставленный ход с тем же context_hash уже записан
         cursor.execute("""
             INSERT INTO messages 
             (user_id, message_text, bot_response, message_type, emotions, style, 
-             typing_time, thinking_time, context_hash, emotional_score, topic_tags)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+             typing_time, thinking_time, context_hash, emotional_score, topic_tags, timestamp, analysis)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (context_hash) DO NOTHING
         """, (
-            user_id, 
-            user_message, 
-            bot_response,
+            exchange['user_id'],
+            exchange['user_message'],
+            exchange['bot_response'],
             'text',
-            json.dumps(emotional_state),
-            response_metrics.get('conversation_style', 'balanced'),
-            response_metrics.get('typing_time', 0),
-            response_metrics.get('thinking_time', 0),
-            context_hash,
-            emotional_state.get('intensity', 0.5),
-            json.dumps(topics)
+            json.dumps(exchange['emotional_state']),
+            exchange['response_metrics'].get('conversation_style', 'balanced'),
+            exchange['response_metrics'].get('typing_time', 0),
+            exchange['response_metrics'].get('thinking_time', 0),
+            exchange['context_hash'],
+            exchange['emotional_state'].get('intensity', 0.5),
+            json.dumps(exchange['topics']),
+            exchange['timestamp'],
+            json.dumps(exchange['analysis'])
         ))
+        if cursor.rowcount == 0:
+            continue
+        stored.append(exchange)
+        postings.extend(
+            (exchange['user_id'], topic, cursor.lastrowid) for topic in exchange['analysis']['topics']
+        )
+        if exchange.get('vector') is not None:
+            vectors.append((exchange['user_id'], cursor.lastrowid, exchange['vector']))
+    
+    cursor.executemany(HOT_QUERIES['update_last_interaction'], [(exchange['timestamp'], exchange['user_id']) for exchange in stored])
+    cursor.executemany(HOT_QUERIES['insert_topic_posting'], postings)
+    cursor.executemany(HOT_QUERIES['insert_processed_update'], [
+        (chat_id, message_id, exchange['context_hash'], exchange['timestamp'])
+        for exchange in stored for chat_id, message_id in exchange['message_keys']
+    ])
+    
+    cursor.executemany("""
+        INSERT INTO conversation_context 
+        (user_id, current_topics, historical_topics, emotional_arc, 
+         conversation_rhythm, user_patterns, last_deep_analysis, running_stats)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            current_topics = excluded.current_topics,
+            historical_topics = excluded.historical_topics,
+            emotional_arc = excluded.emotional_arc,
+            conversation_rhythm = excluded.conversation_rhythm,
+            user_patterns = excluded.user_patterns,
+            last_deep_analysis = excluded.last_deep_analysis,
+            running_stats = COALESCE(excluded.running_stats, running_stats),
+            updated_at = CURRENT_TIMESTAMP
+    """, [(
+        user_id,
+        json.dumps(item['deep_context']['current_topics']),
+        json.dumps(item['deep_context']['historical_topics']),
+        json.dumps(item['deep_context']['emotional_arc']),
+        json.dumps(item['deep_context']['conversation_rhythm']),
+        json.dumps(item['deep_context']['user_patterns']),
+        item['timestamp'],
+        json.dumps(item['conversation_stats']) if item['conversation_stats'] is not None else None
+    ) for user_id, item in contexts.items()])
+    
+    cursor.executemany("""
+        INSERT INTO conversation_memory 
+        (user_id, memory_type, content, emotional_weight, created_at)
+        VALUES (?, 'associative', ?, ?, ?)
+    """, [(
+        exchange['user_id'],
+        exchange['memory_reference'],
+        exchange['emotional_state'].get('intensity', 0.5),
+        exchange['timestamp']
+    ) for exchange in stored if exchange['memory_reference']])
+    
+    # Векторы дописываются после фиксации транзакции
+    return vectors
+
+def _recall_topic_postings(conn: sqlite3.Connection, user_id: int, topics: List[str],
+                           per_topic: int) -> Dict[int, Dict[str, Any]]:
+    """Сообщения пользователя с общими темами: id -> {'topics', 'timestamp'}"""
+    candidates = {}
+    for topic in topics:
+        rows = conn.execute(HOT_QUERIES['topic_postings'], (user_id, topic, per_topic))
+        for message_id, timestamp in rows:
+            candidate = candidates.get(message_id)
+            if candidate is None:
+                candidate = candidates[message_id] = {
+                    'topics': set(),
+                    'timestamp': datetime.fromisoformat(timestamp) if isinstance(timestamp, str) else timestamp
+                }
+            candidate['topics'].add(topic)
+    return candidates
+
+def _recall_memories(conn: sqlite3.Connection, user_id: int, topics: List[str],
+                     query: np.ndarray, per_topic: int) -> Dict[int, Dict[str, Any]]:
+    """Кандидаты в воспоминания: по общим темам и по близости векторов"""
+    candidates = _recall_topic_postings(conn, user_id, topics, per_topic)
+    for candidate in candidates.values():
+        candidate['similarity'] = 0.0
+        candidate['message_topics'] = []
+    
+    if not query.any():
+        return candidates
+    
+    for message_id, similarity in vector_memory.search(user_id, query):
+        if similarity < MEMORY_VECTOR_MIN_SIMILARITY:
+            break
+        if message_id in candidates:
+            candidates[message_id]['similarity'] = similarity
+            continue
         
-        cursor.execute("""
-            INSERT OR REPLACE INTO conversation_context 
-            (user_id, current_topics, historical_topics, emotional_arc, 
-             conversation_rhythm, user_patterns, unfinished_threads, last_deep_analysis)
-            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (
-            user_id,
-            json.dumps(deep_context.get('current_topics', {})),
-            json.dumps(deep_context.get('historical_topics', {})),
-            json.dumps(deep_context.get('emotional_arc', {})),
-            json.dumps(deep_context.get('conversation_rhythm', {})),
-            json.dumps(deep_context.get('user_patterns', {})),
-            json.dumps(deep_context.get('unfinished_threads', {}))
-        ))
+        row = conn.execute(HOT_QUERIES['message_by_id'], (message_id, user_id)).fetchone()
+        if row is None:
+            continue
+        timestamp, analysis = row
+        # Темы того сообщения, ближайшая к запросу - первой
+        message_topics = list(json.loads(analysis).get('topics', {})) if analysis else []
+        message_topics.sort(key=lambda topic: -float(memory_vectorizer.transform(topic) @ query))
+        candidates[message_id] = {
+            'topics': set(),
+            'timestamp': datetime.fromisoformat(timestamp) if isinstance(timestamp, str) else timestamp,
+            'similarity': similarity,
+            'message_topics': message_topics
+        }
+    return candidates
+
+async def save_complete_context(user_id: int, user_message: str, bot_response: str, 
+                                deep_context: Dict[str, Any], emotional_state: Dict[str, Any],
+                                response_metrics: Dict[str, Any], memory_reference: Optional[str] = None,
+                                stats: Optional[ConversationStats] = None,
+                                message_keys: Optional[List[tuple]] = None):
+    """Сохранение полного контекста беседы (через очередь отложенной записи).
+    
+    message_keys - (chat_id, message_id) сообщений хода; по последнему из них
+    строится детерминированный context_hash, так что повторная доставка
+    того же хода не создает второй строки в messages.
+    """
+    try:
+        analysis = analyze_message(user_message)
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        
+        # Накопленная статистика обновляется за O(1) текущим сообщением
+        if stats is not None:
+            stats.update(analysis['emotional_score'], datetime.fromisoformat(timestamp))
+        
+        if message_keys:
+            chat_id, message_id = message_keys[-1]
+            context_hash = hashlib.md5(f"{user_id}:{chat_id}:{message_id}".encode()).hexdigest()
+        else:
+            context_hash = hashlib.md5(
+                f"{user_id}{user_message}{datetime.now().timestamp()}".encode()
+            ).hexdigest()
         
-        if memory_reference:
-            cursor.execute("""
-                INSERT INTO conversation_memory 
-                (user_id, memory_type, content, emotional_weight)
-                VALUES (?, 'associative', ?, ?)
-            """, (user_id, memory_reference, emotional_state.get('intensity', 0.5)))
+        # Сохраняются только секции, которые кто-то читает
+        persisted_context = {
+            section: deep_context.get(section) or {} for section in PERSISTED_CONTEXT_SECTIONS
+        }
+        
+        exchange = {
+            'user_id': user_id,
+            'user_message': user_message,
+            'bot_response': bot_response,
+            'deep_context': persisted_context,
+            'emotional_state': emotional_state,
+            'response_metrics': response_metrics,
+            'memory_reference': memory_reference,
+            'context_hash': context_hash,
+            'message_keys': message_keys or [],
+            'topics': list(persisted_context['current_topics'].keys())[:5],
+            'analysis': persisted_analysis(analysis),
+            'vector': memory_vectorizer.transform(user_message),
+            'conversation_stats': stats.to_dict() if stats is not None else None,
+            'timestamp': timestamp
+        }
+        write_queue.enqueue(exchange)
+        conversation_context.apply_exchange(user_id, exchange)
         
-        conn.commit()
-        conn.close()
+        if stats is not None:
+            conversation_summarizer.note_message(user_id, stats.count)
         
     except Exception as e:
         logger.error(f"Ошибка сохранения контекста для пользователя {user_id}: {e}")
 
-def save_bot_personality(user_id: int, personality: Dict[str, Any]):
+def _store_bot_personality(conn: sqlite3.Connection, user_id: int, personality: Dict[str, Any]):
+    conn.execute("""
+        INSERT OR REPLACE INTO bot_personality (user_id, personality_data, created_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+    """, (user_id, json.dumps(personality)))
+
+async def save_bot_personality(user_id: int, personality: Dict[str, Any]):
     """Сохранение личности бота для пользователя"""
     try:
-        conn = sqlite3.connect("bot_users.db")
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT OR REPLACE INTO bot_personality (user_id, personality_data, created_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        """, (user_id, json.dumps(personality)))
-        
-        conn.commit()
-        conn.close()
+        await user_database.write(_store_bot_personality, user_id, personality)
+        conversation_context.apply_personality(user_id, personality)
         
     except Exception as e:
         logger.error(f"Ошибка сохранения личности бота для пользователя {user_id}: {e}")
@@ -1062,265 +1985,1514 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if update and update.message:
         try:
-            await update.message.reply_text(
-                "⚠️ Произошла ошибка при обработке сообщения. Попробуйте еще раз позже."
+            await send_reply(
+                update.message,
+                "⚠️ Произошла ошибка при обработке сообщения. Попробуйте еще раз позже.",
+                PRIORITY_DIAGNOSTIC
             )
         except Exception as e:
             logger.error(f"Не удалось отправить сообщение об ошибке: {e}")
 
+def _migration_base_schema(conn: sqlite3.Connection):
+    """Исходная схема базы данных"""
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            gender TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_interaction DATETIME,
+            conversation_style TEXT DEFAULT 'balanced',
+            emotional_profile TEXT
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message_text TEXT,
+            bot_response TEXT,
+            message_type TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            emotions TEXT,
+            style TEXT,
+            typing_time REAL,
+            thinking_time REAL,
+            context_hash TEXT,
+            emotional_score REAL,
+            topic_tags TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_context (
+            user_id INTEGER PRIMARY KEY,
+            current_topics TEXT,
+            historical_topics TEXT,
+            emotional_arc TEXT,
+            conversation_rhythm TEXT,
+            user_patterns TEXT,
+            unfinished_threads TEXT,
+            last_deep_analysis DATETIME,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_memory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            memory_type TEXT,
+            content TEXT,
+            emotional_weight REAL,
+            last_recalled DATETIME,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_personality (
+            user_id INTEGER PRIMARY KEY,
+            personality_data TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_facts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            fact_type TEXT,
+            fact_value TEXT,
+            confidence REAL DEFAULT 1.0,
+            last_updated DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            UNIQUE(user_id, fact_type)
+        )
+    ''')
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, declaration: str):
+    """Добавление колонки, если ее еще нет"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+def _migration_messages_count(conn: sqlite3.Connection):
+    """Счетчик сообщений пользователя вместо подсчета по таблице messages"""
+    _add_column(conn, 'users', 'messages_count', 'INTEGER DEFAULT 0')
+    conn.execute("""
+        UPDATE users SET messages_count = (
+            SELECT COUNT(*) FROM messages WHERE messages.user_id = users.user_id
+        )
+    """)
+
+def _migration_conversation_stats(conn: sqlite3.Connection):
+    """Накопленная статистика беседы; по истории заполняется командой backfill"""
+    _add_column(conn, 'conversation_context', 'running_stats', 'TEXT')
+
+def _migration_topic_postings(conn: sqlite3.Connection):
+    """Инвертированный индекс тема -> сообщения; по истории заполняется командой backfill"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS topic_postings (
+            user_id INTEGER NOT NULL,
+            topic TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, topic, message_id)
+        ) WITHOUT ROWID
+    """)
+
+def _migration_conversation_summary(conn: sqlite3.Connection):
+    """Скользящее резюме беседы: до какого сообщения свернуто и сколько обменов в нем"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summary (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            messages_folded INTEGER DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+def _migration_processed_updates(conn: sqlite3.Connection):
+    """Обработанные сообщения для идемпотентности и уникальный context_hash"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            context_hash TEXT,
+            processed_at DATETIME NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_time ON processed_updates (processed_at)")
+    
+    # Старые хеши включали время и совпадать не должны, но уникальный индекс не должен падать
+    conn.execute("""
+        UPDATE messages SET context_hash = NULL
+        WHERE context_hash IS NOT NULL
+          AND id NOT IN (SELECT MIN(id) FROM messages GROUP BY context_hash)
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_context_hash ON messages (context_hash)")
+
+# Упорядоченный список миграций: (версия, описание, список SQL или функция(conn))
+SCHEMA_MIGRATIONS = [
+    (1, 'исходная схема', _migration_base_schema),
+    (2, 'индексы для горячих запросов', [
+        "CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_memory_user ON conversation_memory (user_id, created_at)",
+        """CREATE INDEX IF NOT EXISTS idx_user_facts_covering
+           ON user_facts (user_id, fact_type, confidence, last_updated, fact_value)""",
+    ]),
+    (3, 'users.messages_count', _migration_messages_count),
+    (4, 'messages.analysis', lambda conn: _add_column(conn, 'messages', 'analysis', 'TEXT')),
+    (5, 'conversation_context.running_stats', _migration_conversation_stats),
+    (6, 'topic_postings', _migration_topic_postings),
+    (7, 'conversation_summary', _migration_conversation_summary),
+    (8, 'processed_updates', _migration_processed_updates),
+    (9, 'индекс сообщений по user_id и id', [
+        "CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id, id)",
+    ]),
+    (10, 'shard_layout', [
+        """CREATE TABLE IF NOT EXISTS shard_layout (
+               id INTEGER PRIMARY KEY CHECK (id = 1),
+               shard_index INTEGER NOT NULL,
+               shard_count INTEGER NOT NULL
+           )""",
+    ]),
+]
+
+# Запросы горячего пути; проверяются через EXPLAIN QUERY PLAN
+HOT_QUERIES = {
+    'user': """
+        SELECT messages_count, last_interaction FROM users WHERE user_id = ?
+    """,
+    'recent_messages': """
+        SELECT message_text, bot_response, timestamp, emotional_score, topic_tags, analysis 
+        FROM messages 
+        WHERE user_id = ? 
+        ORDER BY timestamp DESC 
+        LIMIT 20
+    """,
+    'conversation_context': """
+        SELECT * FROM conversation_context WHERE user_id = ?
+    """,
+    'bot_personality': """
+        SELECT * FROM bot_personality WHERE user_id = ?
+    """,
+    'user_facts': """
+        SELECT fact_type, fact_value FROM user_facts WHERE user_id = ?
+    """,
+    'user_fact': """
+        SELECT fact_value, confidence FROM user_facts 
+        WHERE user_id = ? AND fact_type = ? 
+        ORDER BY confidence DESC, last_updated DESC 
+        LIMIT 1
+    """,
+    'update_last_interaction': """
+        UPDATE users SET last_interaction = ?, messages_count = messages_count + 1
+        WHERE user_id = ?
+    """,
+    'topic_postings': """
+        SELECT p.message_id, m.timestamp FROM topic_postings p
+        JOIN messages m ON m.id = p.message_id
+        WHERE p.user_id = ? AND p.topic = ?
+        ORDER BY p.message_id DESC
+        LIMIT ?
+    """,
+    'conversation_summary': """
+        SELECT summary FROM conversation_summary WHERE user_id = ?
+    """,
+    'summary_state': """
+        SELECT summary, last_message_id, messages_folded FROM conversation_summary WHERE user_id = ?
+    """,
+    'unsummarized_messages': """
+        SELECT id, message_text, bot_response FROM messages 
+        WHERE user_id = ? AND id > ? 
+        ORDER BY id 
+        LIMIT ?
+    """,
+    'message_by_id': """
+        SELECT timestamp, analysis FROM messages WHERE id = ? AND user_id = ?
+    """,
+    'insert_topic_posting': """
+        INSERT OR IGNORE INTO topic_postings (user_id, topic, message_id) VALUES (?, ?, ?)
+    """,
+    'processed_update': """
+        SELECT context_hash FROM processed_updates WHERE chat_id = ? AND message_id = ?
+    """,
+    'insert_processed_update': """
+        INSERT OR IGNORE INTO processed_updates (chat_id, message_id, context_hash, processed_at)
+        VALUES (?, ?, ?, ?)
+    """,
+    'prune_processed_updates': """
+        DELETE FROM processed_updates WHERE processed_at < ?
+    """,
+}
+
+def check_query_plans(conn: sqlite3.Connection) -> List[str]:
+    """EXPLAIN QUERY PLAN для горячих запросов, возвращает найденные проблемы"""
+    problems = []
+    for name, sql in HOT_QUERIES.items():
+        params = (0,) * sql.count('?')
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[-1]
+            if detail.startswith('SCAN') or 'TEMP B-TREE' in detail:
+                problems.append(f"{name}: {detail}")
+    return problems
+
 class UserDatabase:
-    def __init__(self, db_name="bot_users.db"):
+    """Хранилище SQLite с долгоживущими соединениями в режиме WAL.
+    
+    Вся работа с базой выполняется в выделенных потоках: записи идут через
+    единственный поток-писатель, чтения - через небольшой пул читателей,
+    у каждого потока свое соединение. Обработчики получают awaitable API.
+    """
+    
+    def __init__(self, db_name=DB_NAME, read_workers=DB_READ_WORKERS):
         self.db_name = db_name
-        self.init_database()
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.read_workers = read_workers
+        self._writer = None
+        self._readers = None
     
-    def init_database(self):
-        """Инициализация базы данных с расширенной схемой"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                gender TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_interaction DATETIME,
-                conversation_style TEXT DEFAULT 'balanced',
-                emotional_profile TEXT
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                message_text TEXT,
-                bot_response TEXT,
-                message_type TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                emotions TEXT,
-                style TEXT,
-                typing_time REAL,
-                thinking_time REAL,
-                context_hash TEXT,
-                emotional_score REAL,
-                topic_tags TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversation_context (
-                user_id INTEGER PRIMARY KEY,
-                current_topics TEXT,
-                historical_topics TEXT,
-                emotional_arc TEXT,
-                conversation_rhythm TEXT,
-                user_patterns TEXT,
-                unfinished_threads TEXT,
-                last_deep_analysis DATETIME,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversation_memory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                memory_type TEXT,
-                content TEXT,
-                emotional_weight REAL,
-                last_recalled DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bot_personality (
-                user_id INTEGER PRIMARY KEY,
-                personality_data TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+    def _start(self):
+        """Запуск потоков (лениво, чтобы хранилище можно было открыть повторно после close)"""
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+            self._readers = ThreadPoolExecutor(max_workers=self.read_workers, thread_name_prefix='sqlite-reader')
+    
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается один раз на поток)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_name,
+                timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                check_same_thread=False
             )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_facts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                fact_type TEXT,
-                fact_value TEXT,
-                confidence REAL DEFAULT 1.0,
-                last_updated DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id),
-                UNIQUE(user_id, fact_type)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def _run(self, func, args):
+        return func(self._connection(), *args)
+    
+    def _run_write(self, func, args):
+        conn = self._connection()
+        with conn:
+            return func(conn, *args)
+    
+    async def read(self, func, *args):
+        """Выполнение func(conn, *args) в пуле читателей"""
+        self._start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run, func, args)
+    
+    async def write(self, func, *args):
+        """Выполнение func(conn, *args) в потоке-писателе в одной транзакции"""
+        self._start()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run_write, func, args)
+    
+    def close(self):
+        """Завершение потоков и закрытие всех соединений"""
+        if self._writer is not None:
+            self._readers.shutdown(wait=True)
+            self._writer.shutdown(wait=True)
+            self._writer = None
+            self._readers = None
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        logger.info("🗄 Соединения с базой данных закрыты")
+    
+    def init_database(self, check_plans: bool = DB_EXPLAIN_ON_STARTUP):
+        """Инициализация базы данных с расширенной схемой"""
+        self._start()
+        self._writer.submit(self._run, self._migrate, ()).result()
+        logger.info("✅ База данных инициализирована")
+        
+        if check_plans:
+            self.check_query_plans()
+    
+    def _migrate(self, conn: sqlite3.Connection):
+        """Применение недостающих миграций, каждая в своей транзакции"""
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
-        ''')
+        """)
+        current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
         
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована")
+        for version, description, migration in SCHEMA_MIGRATIONS:
+            if version <= current:
+                continue
+            
+            # Блокировка записи берется до повторного чтения версии: процесс,
+            # стартующий одновременно, дождется ее и увидит миграцию примененной
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+                if version <= current:
+                    conn.rollback()
+                    continue
+                
+                if callable(migration):
+                    migration(conn)
+                else:
+                    for statement in migration:
+                        conn.execute(statement)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (version, description)
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"🔧 Применена миграция схемы {version}: {description}")
     
-    def get_user(self, user_id: int) -> Optional[tuple]:
+    def check_query_plans(self) -> List[str]:
+        """Проверка планов горячих запросов на полный просмотр таблиц"""
+        self._start()
+        problems = self._readers.submit(self._run, check_query_plans, ()).result()
+        for problem in problems:
+            logger.warning(f"⚠️ Неоптимальный план запроса {problem}")
+        if not problems:
+            logger.info("✅ Все горячие запросы используют индексы")
+        return problems
+    
+    async def get_user(self, user_id: int) -> Optional[tuple]:
         """Получение пользователя по ID"""
         try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            user = cursor.fetchone()
-            conn.close()
-            return user
+            return await self.read(
+                lambda conn: conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            )
         except Exception as e:
             logger.error(f"Ошибка получения пользователя {user_id}: {e}")
             return None
 
-async def process_message_with_deep_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка сообщения с глубоким контекстным анализом"""
-    try:
-        user_id = update.effective_user.id
-        user_message = update.message.text
-        
-        user_context = get_user_context(user_id)
-        
-        # Сначала проверяем личные вопросы
-        personal_response = handle_personal_questions(user_message, user_context)
-        if personal_response:
-            await update.message.reply_text(personal_response)
-            
-            # Сохраняем контекст даже для простых ответов
-            save_complete_context(
-                user_id, 
-                user_message, 
-                personal_response, 
-                user_context.get('deep_context', {}), 
-                {'dominant_emotion': 'neutral', 'intensity': 0.5, 'emotional_trend': 'stable'}, 
-                {'conversation_style': 'balanced', 'typing_time': 0.5, 'thinking_time': 0.5}
-            )
-            return
-        
-        history = user_context.get('history', [])
-        
-        # Извлечение персональной информации
-        personal_info = extract_personal_info(user_message)
-        for fact_type, fact_value in personal_info.items():
-            save_user_fact(user_id, fact_type, fact_value)
-        
-        # Создание или получение личности бота
-        if 'bot_personality' not in user_context or not user_context['bot_personality']:
-            # Определение пола пользователя по имени (если есть)
-            user_name = user_context.get('user_facts', {}).get('name', '')
-            gender_hint = None
-            if user_name:
-                if any(user_name.endswith(end) for end in ['а', 'я', 'ья']):
-                    gender_hint = 'female'
-                else:
-                    gender_hint = 'male'
-            
-            bot_personality = personality_generator.generate_personality(gender_hint)
-            save_bot_personality(user_id, bot_personality)
-        else:
-            bot_personality = user_context['bot_personality']
-        
-        # Для новых пользователей используем упрощенный режим
-        if len(history) < 3:
-            simple_prompt = f"""
-Ты - {bot_personality['name']}, {', '.join(bot_personality['traits'][:2])}. 
-{bot_personality['backstory']}. Увлекаюсь {', '.join(bot_personality['interests'][:2])}.
+user_database = UserDatabase()
 
-Пользователь написал: "{user_message}". 
-Ответь естественно и кратко, как живой человек в начале беседы. Будь лаконичным (1-2 предложения).
-"""
+class WriteBehindQueue:
+    """Очередь отложенной записи с групповым коммитом.
+    
+    Обмены сообщениями копятся в памяти и пишутся одной транзакцией раз в
+    interval_ms миллисекунд или при накоплении max_rows строк. Повторные
+    REPLACE в conversation_context для одного пользователя схлопываются.
+    """
+    
+    def __init__(self, database: UserDatabase, interval_ms=WRITE_BEHIND_INTERVAL_MS,
+                 max_rows=WRITE_BEHIND_MAX_ROWS):
+        self.database = database
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._exchanges = []
+        self._contexts = {}
+        # Пользователи из пачки, которая пишется прямо сейчас
+        self._in_flight = set()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._stats = {
+            'flushes': 0,
+            'rows_flushed': 0,
+            'contexts_coalesced': 0,
+            'failed_flushes': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0
+        }
+    
+    def depth(self) -> int:
+        """Количество строк, ожидающих записи"""
+        return len(self._exchanges) + len(self._contexts)
+    
+    def has_pending(self, user_id: int) -> bool:
+        """Есть ли незаписанные данные пользователя, в том числе в пачке, которая пишется сейчас"""
+        return (user_id in self._contexts or user_id in self._in_flight
+                or any(e['user_id'] == user_id for e in self._exchanges))
+    
+    def enqueue(self, exchange: Dict[str, Any]):
+        """Постановка обмена сообщениями в очередь"""
+        user_id = exchange['user_id']
+        if user_id in self._contexts:
+            self._stats['contexts_coalesced'] += 1
+        stats = exchange['conversation_stats']
+        if stats is None and user_id in self._contexts:
+            stats = self._contexts[user_id]['conversation_stats']
+        self._contexts[user_id] = {
+            'deep_context': exchange['deep_context'],
+            'conversation_stats': stats,
+            'timestamp': exchange['timestamp']
+        }
+        self._exchanges.append(exchange)
+        
+        if self.depth() >= self.max_rows:
+            self._wakeup.set()
+    
+    def start(self):
+        """Запуск фоновой записи"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    async def flush(self):
+        """Запись всех накопленных строк одной транзакцией"""
+        async with self._flush_lock:
+            if not self.depth():
+                return
             
-            bot_response = await generate_ai_response(simple_prompt, 'balanced')
+            exchanges, self._exchanges = self._exchanges, []
+            contexts, self._contexts = self._contexts, {}
+            # Пока пачка не записана, чтение из базы увидело бы историю без нее:
+            # has_pending остается True, а flush() у читателя ждет этой блокировки
+            self._in_flight = set(contexts) | {exchange['user_id'] for exchange in exchanges}
             
-            save_complete_context(
-                user_id, 
-                user_message, 
-                bot_response, 
-                {'current_topics': {}, 'historical_topics': {}, 'emotional_arc': {}, 
-                 'conversation_rhythm': {}, 'user_patterns': {}, 'unfinished_threads': {}}, 
-                {'dominant_emotion': 'neutral', 'intensity': 0.5, 'emotional_trend': 'stable'}, 
-                {'conversation_style': 'balanced', 'typing_time': 1.0, 'thinking_time': 1.0}
-            )
+            started = time.perf_counter()
+            try:
+                try:
+                    vectors = await self.database.write(_store_exchanges, exchanges, contexts)
+                except Exception as e:
+                    self._stats['failed_flushes'] += 1
+                    logger.error(f"Ошибка групповой записи ({len(exchanges)} сообщений): {e}")
+                    # Возвращаем строки в очередь, новые контексты важнее старых
+                    self._exchanges = exchanges + self._exchanges
+                    for user_id, item in contexts.items():
+                        self._contexts.setdefault(user_id, item)
+                    return
+                
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, vector_memory.add_many, vectors)
+                except Exception as e:
+                    logger.error(f"Ошибка записи векторной памяти: {e}")
+            finally:
+                self._in_flight = set()
             
-            await update.message.reply_text(bot_response)
-            return
-        
-        # Для пользователей с историей - полный анализ
-        deep_context = context_analyzer.extract_deep_context(user_message, history, user_context)
-        emotional_state = emotional_intelligence.analyze_emotional_state(user_message, history)
-        memory_reference = memory_system.create_contextual_memory(user_message, history, user_context)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._stats['flushes'] += 1
+            self._stats['rows_flushed'] += len(exchanges) + len(contexts)
+            self._stats['last_flush_ms'] = elapsed_ms
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+            self._stats['total_flush_ms'] += elapsed_ms
+    
+    async def stop(self):
+        """Остановка фоновой записи с финальным сбросом очереди"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.depth():
+            logger.error(f"Не удалось записать {self.depth()} строк при остановке")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Метрики очереди для подбора interval_ms и max_rows"""
+        flushes = self._stats['flushes']
+        return {
+            'depth': self.depth(),
+            'flushes': flushes,
+            'rows_flushed': self._stats['rows_flushed'],
+            'contexts_coalesced': self._stats['contexts_coalesced'],
+            'failed_flushes': self._stats['failed_flushes'],
+            'last_flush_ms': round(self._stats['last_flush_ms'], 2),
+            'avg_flush_ms': round(self._stats['total_flush_ms'] / flushes, 2) if flushes else 0.0,
+            'max_flush_ms': round(self._stats['max_flush_ms'], 2)
+        }
+
+write_queue = WriteBehindQueue(user_database)
+
+class MessageCoalescer:
+    """Склейка сообщений, пришедших подряд, в один ход беседы.
+    
+    Первое сообщение серии становится ведущим: оно ждет, пока пользователь
+    не замолчит на window секунд (но не дольше max_delay), а все сообщения,
+    пришедшие за это время, забирает себе. Серия остается открытой, пока
+    ведущий ждет свою очередь в полосе пользователя, и закрывается вызовом
+    take или по набору max_messages сообщений. Остальные обработчики сразу завершаются, поэтому на серию уходит
+    один вызов модели и одна запись.
+    """
+    
+    def __init__(self, window=COALESCE_WINDOW, max_delay=COALESCE_MAX_DELAY,
+                 max_messages=COALESCE_MAX_MESSAGES):
+        self.window = window
+        self.max_delay = max_delay
+        self.max_messages = max_messages
+        self._buffers = {}
+        self._stats = {'turns': 0, 'messages': 0}
+    
+    async def collect(self, user_id: int, update: Update) -> Optional[Dict[str, Any]]:
+        """Открытая серия для ведущего или None, если сообщение ушло в чужую серию"""
+        self._stats['messages'] += 1
         
-        response_metrics = await conversation_simulator.simulate_human_response(
-            user_message, user_context, history
-        )
+        buffer = self._buffers.get(user_id)
+        if buffer is not None:
+            buffer['updates'].append(update)
+            buffer['last'] = time.monotonic()
+            if len(buffer['updates']) >= self.max_messages:
+                # Серия набрана: следующие сообщения начнут новый ход
+                del self._buffers[user_id]
+            return None
         
-        prompt = create_deep_context_prompt(user_message, deep_context, emotional_state, 
-                                          memory_reference, user_context, bot_personality)
+        now = time.monotonic()
+        buffer = {'updates': [update], 'first': now, 'last': now, 'closed': False}
+        if self.max_messages > 1:
+            self._buffers[user_id] = buffer
         
-        bot_response = await generate_ai_response(prompt, response_metrics['conversation_style'])
+        try:
+            while len(buffer['updates']) < self.max_messages:
+                deadline = min(buffer['last'] + self.window, buffer['first'] + self.max_delay)
+                delay = deadline - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        except BaseException:
+            self.take(user_id, buffer)
+            raise
         
-        bot_response = emotional_intelligence.generate_empathic_response(emotional_state, bot_response)
-        if memory_reference and random.random() < 0.6:
-            bot_response = f"{memory_reference} {bot_response}"
+        return buffer
+    
+    def take(self, user_id: int, buffer: Dict[str, Any]) -> List[Update]:
+        """Закрытие серии; следующие сообщения начнут новую"""
+        if self._buffers.get(user_id) is buffer:
+            del self._buffers[user_id]
+        if not buffer['closed']:
+            buffer['closed'] = True
+            self._stats['turns'] += 1
+        return buffer['updates']
+    
+    def stats(self) -> Dict[str, Any]:
+        """Сколько сообщений и сколько ходов после склейки"""
+        turns = self._stats['turns']
+        return {
+            'messages': self._stats['messages'],
+            'turns': turns,
+            'pending_users': len(self._buffers),
+            'messages_per_turn': round(self._stats['messages'] / turns, 2) if turns else 0.0
+        }
+
+class LaneFull(Exception):
+    """Очередь ходов пользователя переполнена"""
+
+class UserLanes:
+    """Полосы выполнения по user_id.
+    
+    Ходы одного пользователя выполняются строго по очереди (контекст,
+    личность бота и conversation_context не гоняются друг с другом), ходы
+    разных пользователей - параллельно. В полосе не больше max_pending
+    ходов, включая выполняющийся.
+    """
+    
+    def __init__(self, max_pending=LANE_MAX_PENDING):
+        self.max_pending = max_pending
+        self._lanes = {}
+        self._waits = deque(maxlen=1000)
+        self._stats = {'acquired': 0, 'rejected': 0}
+    
+    def _leave(self, user_id, lane):
+        lane['pending'] -= 1
+        if lane['pending'] == 0:
+            del self._lanes[user_id]
+    
+    @asynccontextmanager
+    async def lane(self, user_id: int):
+        """Ожидание своей очереди в полосе пользователя"""
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = {'lock': asyncio.Lock(), 'pending': 0}
         
-        save_complete_context(user_id, user_message, bot_response, deep_context, 
-                            emotional_state, response_metrics, memory_reference)
+        if lane['pending'] >= self.max_pending:
+            self._stats['rejected'] += 1
+            raise LaneFull(f"в полосе пользователя {user_id} уже {lane['pending']} ходов")
         
-        await update.message.reply_text(bot_response)
+        lane['pending'] += 1
+        started = time.monotonic()
+        try:
+            await lane['lock'].acquire()
+        except BaseException:
+            self._leave(user_id, lane)
+            raise
         
-    except Exception as e:
-        logger.error(f"Ошибка обработки сообщения: {e}")
+        self._waits.append(time.monotonic() - started)
+        self._stats['acquired'] += 1
         try:
-            simple_response = await generate_ai_response(
-                f"Пользователь написал: {user_message}. Ответь кратко и естественно.",
-                'balanced'
-            )
-            await update.message.reply_text(simple_response)
-        except:
-            await update.message.reply_text("Привет! Расскажи, что у тебя нового?")
-
-def create_deep_context_prompt(message, deep_context, emotional_state, memory_reference, 
-                              user_context, bot_personality):
-    """Создание промпта с глубоким контекстом"""
-    history_length = len(user_context.get('history', []))
-    user_facts = user_context.get('user_facts', {})
-    user_name = user_facts.get('name', 'друг')
+            yield
+        finally:
+            lane['lock'].release()
+            self._leave(user_id, lane)
     
-    base_prompt = f"""
-Ты - {bot_personality['name']}, {random.choice(bot_personality['traits'])} собеседник.
-{bot_personality['backstory']}. Увлекаюсь {', '.join(bot_personality['interests'][:2])}.
+    def stats(self) -> Dict[str, Any]:
+        """Метрики ожидания в полосах"""
+        waits = sorted(self._waits)
+        return {
+            'active_lanes': len(self._lanes),
+            'acquired': self._stats['acquired'],
+            'rejected': self._stats['rejected'],
+            'wait_avg_ms': round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            'wait_p95_ms': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            'wait_max_ms': round(waits[-1] * 1000, 1) if waits else 0.0
+        }
 
-Пользователь: {user_name}
-Сообщение: {message}
-Эмоции: {emotional_state.get('dominant_emotion', 'neutral')}
-"""
+def _load_processed_update(conn: sqlite3.Connection, chat_id: int, message_id: int) -> Optional[tuple]:
+    return conn.execute(HOT_QUERIES['processed_update'], (chat_id, message_id)).fetchone()
 
-    # Добавляем исторические темы если есть
-    historical_topics = deep_context.get('historical_topics', {})
-    if historical_topics:
-        base_prompt += f"\nРанее обсуждали: {', '.join(list(historical_topics.keys())[:2])}"
+def _prune_processed_updates(conn: sqlite3.Connection, cutoff: str):
+    conn.execute(HOT_QUERIES['prune_processed_updates'], (cutoff,))
+
+class ProcessedUpdates:
+    """Идемпотентность обработки сообщений по (chat_id, message_id).
     
-    # Добавляем воспоминания если есть
-    if memory_reference:
-        base_prompt += f"\n{memory_reference}"
+    После перезапуска или при повторе вебхука Telegram доставляет те же
+    сообщения еще раз. Ключи принятых сообщений держатся в LRU в памяти, а
+    записанные ходы - в таблице processed_updates вместе со строкой messages.
+    При промахе LRU проверяется таблица (поиск по первичному ключу): повтор
+    мог прийти в другой процесс за балансировщиком или после перезапуска.
+    Повтор отбрасывается без обращения к модели - ответ на него уже отправлен
+    (ход записывается после отправки) или отправляется прямо сейчас.
+    """
     
-    base_prompt += f"""
-\nОтвечай естественно, как {bot_personality['name']}.
+    def __init__(self, capacity=IDEMPOTENCY_CACHE_SIZE):
+        self.capacity = capacity
+        self._seen = OrderedDict()
+        self._stats = {'checked': 0, 'duplicates': 0, 'db_lookups': 0}
+    
+    def _remember(self, key):
+        self._seen[key] = True
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.capacity:
+            self._seen.popitem(last=False)
+    
+    async def claim(self, update: Update) -> bool:
+        """True, если сообщение видим впервые и его нужно обработать"""
+        message = update.message
+        key = (message.chat_id, message.message_id)
+        self._stats['checked'] += 1
+        
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            self._stats['duplicates'] += 1
+            return False
+        
+        # Ключ занимается до обращения к базе, чтобы параллельный повтор не прошел
+        self._remember(key)
+        self._stats['db_lookups'] += 1
+        if await user_database.read(_load_processed_update, *key):
+            self._stats['duplicates'] += 1
+            return False
+        return True
+    
+    async def prune(self):
+        """Удаление записей старше IDEMPOTENCY_RETENTION_HOURS"""
+        cutoff = time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - IDEMPOTENCY_RETENTION_HOURS * 3600)
+        )
+        await user_database.write(_prune_processed_updates, cutoff)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, 'cached': len(self._seen)}
+
+class InFlightTurns:
+    """Учет выполняющихся ходов для дренажа при остановке.
+    
+    При остановке новые обновления уже не принимаются, а начатые ходы и
+    принятые в очередь обновления получают время до дедлайна. Все, что не
+    успело, отменяется и считается брошенным. Ходом считается любое
+    обновление, взятое из очереди, в том числе команда и обновление, которое
+    еще ждет свободного места под MAX_CONCURRENT_UPDATES.
+    """
+    
+    def __init__(self):
+        self.closed = False
+        self._tasks = set()
+        self._stats = {'started': 0, 'abandoned': 0}
+    
+    @asynccontextmanager
+    async def track(self):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self._stats['started'] += 1
+        try:
+            yield
+        finally:
+            self._tasks.discard(task)
+    
+    def abandon(self):
+        """Ход пришел после дедлайна дренажа"""
+        self._stats['abandoned'] += 1
+    
+    async def drain(self, update_queue: asyncio.Queue, deadline: float) -> int:
+        """Ожидание начатых ходов и очереди обновлений до deadline; возвращает число брошенных"""
+        while (self._tasks or not update_queue.empty()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        
+        self.closed = True
+        abandoned = 0
+        while not update_queue.empty():
+            update_queue.get_nowait()
+            update_queue.task_done()
+            abandoned += 1
+        
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        self._stats['abandoned'] += abandoned + len(tasks)
+        return abandoned + len(tasks)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, 'in_flight': len(self._tasks)}
+
+message_coalescer = MessageCoalescer()
+user_lanes = UserLanes()
+in_flight_turns = InFlightTurns()
+processed_updates = ProcessedUpdates()
+
+class TrackedUpdateProcessor(SimpleUpdateProcessor):
+    """Обработка обновлений с учетом в in_flight_turns с момента, как обновление взято из очереди"""
+    
+    async def process_update(self, update, coroutine):
+        if in_flight_turns.closed:
+            coroutine.close()
+            in_flight_turns.abandon()
+            return
+        
+        async with in_flight_turns.track():
+            await super().process_update(update, coroutine)
+
+async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Прием текстового сообщения: серия сообщений подряд обрабатывается одним ходом"""
+    if not await processed_updates.claim(update):
+        logger.info(f"Повторная доставка сообщения {update.message.message_id} пропущена")
+        return
+    
+    user_id = update.effective_user.id
+    buffer = await message_coalescer.collect(user_id, update)
+    if buffer is None:
+        return
+    
+    try:
+        async with user_lanes.lane(user_id):
+            updates = message_coalescer.take(user_id, buffer)
+            user_message = "\n".join(u.message.text for u in updates)
+            message_keys = [(u.message.chat_id, u.message.message_id) for u in updates]
+            await process_message_with_deep_context(updates[-1], context, user_message, message_keys)
+    except LaneFull as e:
+        # Сообщения уже отмечены обработанными и повторно не придут - отвечаем сразу
+        logger.warning(f"Ход пропущен: {e}")
+        await send_reply(buffer['updates'][-1].message, BUSY_RESPONSE)
+    finally:
+        message_coalescer.take(user_id, buffer)
+
+async def process_message_with_deep_context(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                            user_message: Optional[str] = None,
+                                            message_keys: Optional[List[tuple]] = None):
+    """Обработка сообщения с глубоким контекстным анализом"""
+    try:
+        user_id = update.effective_user.id
+        user_message = user_message or update.message.text
+        turn_started = time.monotonic()
+        
+        # Статус "печатает..." - с начала хода, пока идут чтение контекста, анализ и генерация
+        async with typing_action(update.effective_chat):
+            user_context = await get_user_context(user_id)
+            stats = ConversationStats(user_context.get('conversation_stats'))
+            
+            # Сначала проверяем личные вопросы
+            personal_response = await handle_personal_questions(user_message, user_context)
+            if personal_response:
+                await send_reply(update.message, personal_response)
+                
+                # Сохраняем контекст даже для простых ответов
+                await save_complete_context(
+                    user_id, 
+                    user_message, 
+                    personal_response, 
+                    user_context.get('deep_context', {}), 
+                    {'dominant_emotion': 'neutral', 'intensity': 0.5, 'emotional_trend': 'stable'}, 
+                    {'conversation_style': 'balanced', 'typing_time': 0.5, 'thinking_time': 0.5},
+                    stats=stats, message_keys=message_keys
+                )
+                return
+            
+            history = user_context.get('history', [])
+            
+            # Извлечение персональной информации
+            personal_info = extract_personal_info(user_message)
+            for fact_type, fact_value in personal_info.items():
+                await save_user_fact(user_id, fact_type, fact_value)
+            
+            # Создание или получение личности бота
+            if 'bot_personality' not in user_context or not user_context['bot_personality']:
+                # Определение пола пользователя по имени (если есть)
+                user_name = user_context.get('user_facts', {}).get('name', '')
+                gender_hint = None
+                if user_name:
+                    if any(user_name.endswith(end) for end in ['а', 'я', 'ья']):
+                        gender_hint = 'female'
+                    else:
+                        gender_hint = 'male'
+                
+                bot_personality = personality_generator.generate_personality(gender_hint)
+                await save_bot_personality(user_id, bot_personality)
+            else:
+                bot_personality = user_context['bot_personality']
+            
+            # Для новых пользователей используем упрощенный режим
+            if len(history) < 3:
+                simple_prompt = f"""
+Ты - {bot_personality['name']}, {', '.join(bot_personality['traits'][:2])}. 
+{bot_personality['backstory']}. Увлекаюсь {', '.join(bot_personality['interests'][:2])}.
+
+Пользователь написал: "{user_message}". 
+Ответь естественно и кратко, как живой человек в начале беседы. Будь лаконичным (1-2 предложения).
+"""
+                
+                bot_response = await reply_with_ai_response(
+                    update.message, simple_prompt, 'balanced', user_id=user_id, path='new_user'
+                )
+                
+                await save_complete_context(
+                    user_id, 
+                    user_message, 
+                    bot_response, 
+                    {'current_topics': {}, 'historical_topics': {}, 'emotional_arc': {}, 
+                     'conversation_rhythm': {}, 'user_patterns': {}, 'unfinished_threads': {}}, 
+                    {'dominant_emotion': 'neutral', 'intensity': 0.5, 'emotional_trend': 'stable'}, 
+                    {'conversation_style': 'balanced', 'typing_time': 1.0, 'thinking_time': 1.0},
+                    stats=stats, message_keys=message_keys
+                )
+                return
+            
+            # Для пользователей с историей - полный анализ
+            deep_context, emotional_state, memory_reference = await analysis_stage.analyze(
+                user_message, history, user_context, stats
+            )
+            
+            # Имитируемая задержка отсчитывается от начала хода: анализ и генерация идут внутри нее
+            response_metrics = conversation_simulator.plan_human_response(
+                user_message, user_context, history
+            )
+            not_before = turn_started + response_metrics['delay']
+            
+            prompt = create_deep_context_prompt(user_message, deep_context, emotional_state, 
+                                              memory_reference, user_context, bot_personality)
+            
+            bot_response = await reply_with_ai_response(
+                update.message, prompt, response_metrics['conversation_style'],
+                lambda text: finalize_bot_response(text, emotional_state, memory_reference),
+                user_id=user_id, not_before=not_before
+            )
+            
+            await save_complete_context(user_id, user_message, bot_response, deep_context, 
+                                        emotional_state, response_metrics, memory_reference, stats, message_keys)
+            
+    except Exception as e:
+        logger.error(f"Ошибка обработки сообщения: {e}")
+        try:
+            simple_response = await generate_ai_response(
+                f"Пользователь написал: {user_message}. Ответь кратко и естественно.",
+                'balanced', user_id, path='fallback'
+            )
+            await send_reply(update.message, simple_response)
+        except:
+            await send_reply(update.message, "Привет! Расскажи, что у тебя нового?")
+
+def finalize_bot_response(bot_response, emotional_state, memory_reference):
+    """Эмпатичное оформление ответа и ссылка на воспоминание"""
+    bot_response = emotional_intelligence.generate_empathic_response(emotional_state, bot_response)
+    if memory_reference and random.random() < 0.6:
+        bot_response = f"{memory_reference} {bot_response}"
+    return bot_response
+
+def create_deep_context_prompt(message, deep_context, emotional_state, memory_reference, 
+                              user_context, bot_personality):
+    """Создание промпта с глубоким контекстом в пределах PROMPT_TOKEN_BUDGET"""
+    user_facts = user_context.get('user_facts', {})
+    user_name = user_facts.get('name', 'друг')
+    
+    prompt = PromptBuilder()
+    prompt.add(f"""
+Ты - {bot_personality['name']}, {random.choice(bot_personality['traits'])} собеседник.
+{bot_personality['backstory']}. Увлекаюсь {', '.join(bot_personality['interests'][:2])}.
+
+Пользователь: {user_name}
+Сообщение: {message}
+Эмоции: {emotional_state.get('dominant_emotion', 'neutral')}
+""")
+
+    # Добавляем исторические темы если есть
+    historical_topics = deep_context.get('historical_topics', {})
+    if historical_topics:
+        prompt.add(f"\nРанее обсуждали: {', '.join(list(historical_topics.keys())[:2])}", priority=1)
+    
+    # Резюме прошлых бесед фиксированного размера вместо сырой истории
+    summary = user_context.get('conversation_summary')
+    if summary:
+        prompt.add(f"\nО чем говорили раньше: {summary}", priority=3)
+    
+    # Добавляем воспоминания если есть
+    if memory_reference:
+        prompt.add(f"\n{memory_reference}", priority=2)
+    
+    prompt.add(f"""
+\nОтвечай естественно, как {bot_personality['name']}.
 Используй стиль: {bot_personality['speech_style']}
 Будь {random.choice(bot_personality['traits'])}
 \nТвой ответ:
-"""
+""")
     
-    return base_prompt
+    return prompt.build()
+
+def estimate_tokens(text: str) -> int:
+    """Грубая локальная оценка числа токенов (для русского текста ~3 символа на токен)"""
+    return len(text) // 3 + 1
 
-async def generate_ai_response(prompt, style):
-    """Генерация ответа с учетом стиля"""
+class PromptBuilder:
+    """Сборка промпта из секций в пределах бюджета токенов.
+    
+    Обязательные секции (priority=None) входят всегда, необязательные
+    добавляются по возрастанию priority, пока хватает бюджета. В тексте
+    секции остаются в порядке добавления.
+    """
+    
+    def __init__(self, budget=PROMPT_TOKEN_BUDGET):
+        self.budget = budget
+        self.tokens = 0
+        self.dropped = 0
+        self._sections = []
+    
+    def add(self, text: str, priority: Optional[int] = None):
+        if text:
+            self._sections.append((priority, text, estimate_tokens(text)))
+        return self
+    
+    def build(self) -> str:
+        chosen = {index for index, (priority, _, _) in enumerate(self._sections) if priority is None}
+        used = sum(self._sections[index][2] for index in chosen)
+        
+        optional = sorted(
+            (priority, index) for index, (priority, _, _) in enumerate(self._sections) if priority is not None
+        )
+        for _, index in optional:
+            cost = self._sections[index][2]
+            if used + cost <= self.budget:
+                chosen.add(index)
+                used += cost
+            else:
+                self.dropped += 1
+        
+        self.tokens = used
+        token_usage.record_prompt_build(self.dropped)
+        return ''.join(text for index, (_, text, _) in enumerate(self._sections) if index in chosen)
+
+def completion_max_tokens(path: str, style: str) -> int:
+    """maxTokens для пути генерации (new_user, deep, fallback, summary) и стиля"""
+    limits = COMPLETION_MAX_TOKENS.get(path, COMPLETION_MAX_TOKENS['deep'])
+    return limits.get(style, limits['default'])
+
+class TokenUsage:
+    """Распределение токенов промпта и ответа по путям генерации.
+    
+    Берется из usage в ответе модели, а если его нет - из локальной оценки.
+    Доля ответов, упершихся в maxTokens, показывает, не слишком ли мал лимит.
+    """
+    
+    def __init__(self, window=1000):
+        self.window = window
+        self._paths = {}
+        self._builds = {'prompts': 0, 'dropped_sections': 0}
+    
+    def record_prompt_build(self, dropped: int):
+        self._builds['prompts'] += 1
+        self._builds['dropped_sections'] += dropped
+    
+    def record(self, path: str, prompt: str, text: str, max_tokens: int, usage: Optional[Dict[str, Any]] = None):
+        """Учет одного запроса к модели"""
+        usage = usage or {}
+        prompt_tokens = int(usage.get('inputTextTokens') or estimate_tokens(prompt))
+        completion_tokens = int(usage.get('completionTokens') or estimate_tokens(text))
+        
+        entry = self._paths.get(path)
+        if entry is None:
+            entry = self._paths[path] = {
+                'prompt': deque(maxlen=self.window),
+                'completion': deque(maxlen=self.window),
+                'requests': 0,
+                'hit_max_tokens': 0
+            }
+        entry['prompt'].append(prompt_tokens)
+        entry['completion'].append(completion_tokens)
+        entry['requests'] += 1
+        if completion_tokens >= max_tokens:
+            entry['hit_max_tokens'] += 1
+    
+    @staticmethod
+    def _distribution(values) -> Dict[str, int]:
+        values = sorted(values)
+        if not values:
+            return {'p50': 0, 'p95': 0, 'max': 0}
+        return {
+            'p50': values[len(values) // 2],
+            'p95': values[int(len(values) * 0.95)],
+            'max': values[-1]
+        }
+    
+    def stats(self) -> Dict[str, Any]:
+        """Перцентили токенов по путям и число отброшенных секций промпта"""
+        report = dict(self._builds)
+        for path, entry in self._paths.items():
+            report[path] = {
+                'requests': entry['requests'],
+                'hit_max_tokens': entry['hit_max_tokens'],
+                'prompt_tokens': self._distribution(entry['prompt']),
+                'completion_tokens': self._distribution(entry['completion'])
+            }
+        return report
+
+token_usage = TokenUsage()
+
+class TokenBucket:
+    """Ведро токенов: пополняется со скоростью rate в секунду до capacity"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_consume(self, amount: float = 1.0) -> bool:
+        """Списание токенов, если их хватает (rate <= 0 - без ограничений)"""
+        if self.rate <= 0:
+            return True
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+    
+    def delay_for(self, amount: float = 1.0) -> float:
+        """Через сколько секунд хватит токенов"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+class LLMQueueTimeout(Exception):
+    """Запрос к модели не дождался своей очереди"""
+
+class LLMScheduler:
+    """Планировщик запросов к Yandex GPT.
+    
+    Ограничивает число одновременных запросов, скорость запросов и токенов
+    (token bucket) и раздает слоты по взвешенной справедливой очереди
+    между пользователями: у каждого запроса есть виртуальное время
+    окончания, и болтливый пользователь уходит в конец очереди, не мешая
+    остальным. Если слот не выдан за max_wait секунд - LLMQueueTimeout.
+    """
+    
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, requests_per_second=LLM_REQUESTS_PER_SECOND,
+                 tokens_per_second=LLM_TOKENS_PER_SECOND, max_wait=LLM_MAX_QUEUE_WAIT):
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.request_bucket = TokenBucket(requests_per_second)
+        self.token_bucket = TokenBucket(tokens_per_second)
+        self.active = 0
+        self._queue = []
+        self._sequence = 0
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        self._timer = None
+        self._waits = deque(maxlen=1000)
+        self._stats = {'granted': 0, 'timeouts': 0}
+    
+    def _enqueue(self, user_id, tokens, weight) -> Dict[str, Any]:
+        start = max(self._virtual_time, self._last_finish.get(user_id, 0.0))
+        finish = start + tokens / max(weight, 0.01)
+        self._last_finish[user_id] = finish
+        
+        waiter = {
+            'future': asyncio.get_running_loop().create_future(),
+            'start': start,
+            'tokens': tokens,
+            'abandoned': False
+        }
+        self._sequence += 1
+        heapq.heappush(self._queue, (finish, self._sequence, waiter))
+        return waiter
+    
+    def _dispatch(self):
+        """Выдача слотов, пока позволяют лимиты"""
+        while self._queue and self.active < self.max_concurrency:
+            finish, _, waiter = self._queue[0]
+            if waiter['abandoned']:
+                heapq.heappop(self._queue)
+                continue
+            
+            delay = max(self.request_bucket.delay_for(1), self.token_bucket.delay_for(waiter['tokens']))
+            if delay > 0:
+                self._schedule_dispatch(delay)
+                return
+            
+            self.request_bucket.try_consume(1)
+            self.token_bucket.try_consume(waiter['tokens'])
+            heapq.heappop(self._queue)
+            self._virtual_time = max(self._virtual_time, waiter['start'])
+            self.active += 1
+            waiter['future'].set_result(True)
+        
+        if not self._queue:
+            # Пользователи, отставшие от виртуального времени, больше не нужны
+            self._last_finish = {
+                user_id: finish for user_id, finish in self._last_finish.items()
+                if finish > self._virtual_time
+            }
+    
+    def _schedule_dispatch(self, delay):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+    
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+    
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, user_id, tokens: int, weight: float = 1.0):
+        """Ожидание слота для запроса к модели"""
+        waiter = self._enqueue(user_id, tokens, weight)
+        started = time.monotonic()
+        self._dispatch()
+        
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter['future']), timeout=self.max_wait)
+        except BaseException as e:
+            if waiter['future'].done():
+                # Слот выдан в момент таймаута или отмены - возвращаем его
+                self._release()
+            else:
+                waiter['abandoned'] = True
+                waiter['future'].cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self._stats['timeouts'] += 1
+                raise LLMQueueTimeout(f"нет слота за {self.max_wait:.0f} с") from None
+            raise
+        
+        self._waits.append(time.monotonic() - started)
+        self._stats['granted'] += 1
+        try:
+            yield
+        finally:
+            self._release()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Метрики очереди: глубина, ожидание слота, отказы по таймауту"""
+        waits = sorted(self._waits)
+        return {
+            'active': self.active,
+            'queued': sum(1 for _, _, waiter in self._queue if not waiter['abandoned']),
+            'granted': self._stats['granted'],
+            'timeouts': self._stats['timeouts'],
+            'wait_avg_ms': round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+            'wait_p95_ms': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            'wait_max_ms': round(waits[-1] * 1000, 1) if waits else 0.0
+        }
+
+llm_scheduler = LLMScheduler()
+
+# Приоритеты исходящих сообщений: меньше - раньше
+PRIORITY_REPLY = 0
+PRIORITY_EDIT = 1
+PRIORITY_DIAGNOSTIC = 2
+PRIORITY_TYPING = 3
+
+class OutboundSender:
+    """Очередь исходящих вызовов Bot API с учетом лимитов Telegram.
+    
+    Общий token bucket ограничивает скорость бота, отдельный bucket на чат -
+    скорость в каждом чате. Сообщения одного чата уходят по порядку, между
+    чатами - по приоритету: ответы в беседе раньше промежуточных правок и
+    служебных сообщений. На 429 чат ставится на паузу на retry_after секунд,
+    и вызов повторяется.
+    """
+    
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, max_retries=TELEGRAM_SEND_RETRIES):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._blocked_until = {}
+        self._queue = []
+        self._sequence = 0
+        self._wakeup = None
+        self._task = None
+        self._in_flight = set()
+        self._latencies = deque(maxlen=1000)
+        self._stats = {'sent': 0, 'retries': 0, 'flood_waits': 0, 'failed': 0}
+    
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def send(self, chat_id, request, priority=PRIORITY_REPLY):
+        """Отправка через очередь; request - функция без аргументов, возвращающая вызов Bot API"""
+        self.start()
+        job = {
+            'chat_id': chat_id,
+            'request': request,
+            'priority': priority,
+            'future': asyncio.get_running_loop().create_future(),
+            'enqueued': time.monotonic(),
+            'attempts': 0
+        }
+        self._push(job)
+        return await job['future']
+    
+    def _push(self, job):
+        self._sequence += 1
+        heapq.heappush(self._queue, (job['priority'], self._sequence, job))
+        self._wakeup.set()
+    
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    def _next_entry(self):
+        """Первая готовая к отправке запись очереди и задержка до следующей"""
+        now = time.monotonic()
+        delay = None
+        waiting_chats = set()
+        
+        for entry in sorted(self._queue):
+            job = entry[2]
+            if job['future'].done():
+                # Отправитель больше не ждет ответа
+                self._queue.remove(entry)
+                continue
+            if job['chat_id'] in waiting_chats:
+                continue
+            
+            wait = max(self._blocked_until.get(job['chat_id'], 0.0) - now,
+                       self._chat_bucket(job['chat_id']).delay_for(1))
+            if wait <= 0:
+                return entry, 0.0
+            waiting_chats.add(job['chat_id'])
+            delay = wait if delay is None else min(delay, wait)
+        
+        heapq.heapify(self._queue)
+        return None, delay
+    
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._prune()
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            
+            global_delay = self.global_bucket.delay_for(1)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+            
+            entry, delay = self._next_entry()
+            if entry is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            job = entry[2]
+            self.global_bucket.try_consume(1)
+            self._chat_bucket(job['chat_id']).try_consume(1)
+            
+            task = asyncio.create_task(self._send(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+    
+    async def _send(self, job):
+        job['attempts'] += 1
+        try:
+            result = await job['request']()
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            self._stats['flood_waits'] += 1
+            self._blocked_until[job['chat_id']] = time.monotonic() + retry_after
+            logger.warning(f"Telegram просит подождать {retry_after} с (чат {job['chat_id']})")
+            self._retry(job, e)
+        except BadRequest as e:
+            self._fail(job, e)
+        except NetworkError as e:
+            self._blocked_until[job['chat_id']] = time.monotonic() + 0.5 * 2 ** job['attempts']
+            self._retry(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self._stats['sent'] += 1
+            self._latencies.append(time.monotonic() - job['enqueued'])
+            if not job['future'].done():
+                job['future'].set_result(result)
+    
+    def _retry(self, job, error):
+        if job['attempts'] > self.max_retries or job['future'].done():
+            self._fail(job, error)
+            return
+        self._stats['retries'] += 1
+        self._push(job)
+    
+    def _fail(self, job, error):
+        self._stats['failed'] += 1
+        if not job['future'].done():
+            job['future'].set_exception(error)
+    
+    def _prune(self):
+        """Удаление состояния чатов, которые давно ничего не отправляли"""
+        now = time.monotonic()
+        self._blocked_until = {chat_id: until for chat_id, until in self._blocked_until.items() if until > now}
+        self._chat_buckets = {
+            chat_id: bucket for chat_id, bucket in self._chat_buckets.items()
+            if bucket.delay_for(bucket.capacity) > 0
+        }
+    
+    async def stop(self, timeout: float = 5.0):
+        """Досылка очереди (не дольше timeout секунд) и остановка"""
+        deadline = time.monotonic() + timeout
+        while (self._queue or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for _, _, job in self._queue:
+            self._fail(job, RuntimeError("отправка прервана остановкой бота"))
+        self._queue.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Метрики отправки: очередь, задержка от постановки до доставки, повторы"""
+        latencies = sorted(self._latencies)
+        return {
+            **self._stats,
+            'queued': len(self._queue),
+            'in_flight': len(self._in_flight),
+            'blocked_chats': sum(1 for until in self._blocked_until.values() if until > time.monotonic()),
+            'latency_avg_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+            'latency_p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else 0.0,
+            'latency_max_ms': round(latencies[-1] * 1000, 1) if latencies else 0.0
+        }
+
+outbound_sender = OutboundSender()
+
+async def send_reply(message, text, priority=PRIORITY_REPLY):
+    """Ответ на сообщение через очередь исходящих"""
+    return await outbound_sender.send(message.chat_id, lambda: message.reply_text(text), priority)
+
+async def edit_reply(sent, text, priority=PRIORITY_EDIT):
+    """Правка отправленного сообщения через очередь исходящих"""
+    return await outbound_sender.send(sent.chat_id, lambda: sent.edit_text(text), priority)
+
+class YandexGPTClient:
+    """Клиент Yandex GPT с общим пулом соединений на все время работы приложения"""
+    
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+    
+    async def start(self):
+        """Создание сессии с настроенным пулом и таймаутами"""
+        if self.session is not None and not self.session.closed:
+            return
+        
+        connector = aiohttp.TCPConnector(
+            limit=LLM_POOL_SIZE,
+            limit_per_host=LLM_POOL_PER_HOST,
+            ttl_dns_cache=LLM_DNS_CACHE_TTL,
+            keepalive_timeout=LLM_KEEPALIVE_TIMEOUT
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=LLM_TOTAL_TIMEOUT,
+            connect=LLM_CONNECT_TIMEOUT,
+            sock_read=LLM_READ_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={
+                "Authorization": f"Api-Key {YANDEX_API_KEY}",
+                "Content-Type": "application/json"
+            }
+        )
+        logger.info("🌐 Пул соединений Yandex GPT открыт")
+    
+    async def close(self):
+        """Закрытие сессии и всех соединений пула"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.info("🌐 Пул соединений Yandex GPT закрыт")
+        self.session = None
+    
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Сессия приложения (создается при первом обращении, если не было start)"""
+        if self.session is None or self.session.closed:
+            await self.start()
+        return self.session
+
+gpt_client = YandexGPTClient()
+
+def build_completion_payload(prompt, style, stream=False, max_tokens=None):
+    """Тело запроса к Yandex GPT с учетом стиля"""
     temperature_map = {
         'active': 0.8,
         'reactive': 0.6,
@@ -1330,17 +3502,12 @@ async def generate_ai_response(prompt, style):
     
     temperature = temperature_map.get(style, 0.7)
     
-    headers = {
-        "Authorization": f"Api-Key {YANDEX_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
+    return {
         "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt-lite",
         "completionOptions": {
-            "stream": False,
+            "stream": stream,
             "temperature": temperature,
-            "maxTokens": 2000
+            "maxTokens": max_tokens or completion_max_tokens('deep', style)
         },
         "messages": [
             {
@@ -1353,24 +3520,397 @@ async def generate_ai_response(prompt, style):
             }
         ]
     }
+
+def completion_cost(prompt, max_tokens=LLM_EXPECTED_COMPLETION_TOKENS) -> int:
+    """Оценка токенов запроса для планировщика"""
+    return estimate_tokens(prompt) + min(max_tokens, LLM_EXPECTED_COMPLETION_TOKENS)
+
+async def generate_ai_response(prompt, style, user_id=None, path='deep'):
+    """Генерация ответа с учетом стиля и пути (new_user, deep, fallback)"""
+    max_tokens = completion_max_tokens(path, style)
+    payload = build_completion_payload(prompt, style, max_tokens=max_tokens)
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(YANDEX_API_URL, headers=headers, json=payload) as response:
+        async with llm_scheduler.slot(user_id, completion_cost(prompt, max_tokens)):
+            session = await gpt_client.get_session()
+            async with session.post(YANDEX_API_URL, json=payload) as response:
                 if response.status == 200:
                     data = await response.json()
-                    return data['result']['alternatives'][0]['message']['text']
+                    text = data['result']['alternatives'][0]['message']['text']
+                    token_usage.record(path, prompt, text, max_tokens, data['result'].get('usage'))
+                    return text
                 else:
                     return "Давай поговорим о чем-то другом? Что тебя интересует?"
+    
+    except LLMQueueTimeout as e:
+        logger.warning(f"Очередь к Yandex GPT переполнена: {e}")
+        return BUSY_RESPONSE
                     
     except Exception as e:
         logger.error(f"Ошибка Yandex GPT: {e}")
         return "Извини, я немного запуталась... Можешь повторить?"
 
+async def stream_ai_response(prompt, style, user_id=None, path='deep'):
+    """Потоковая генерация: выдает накопленный текст по мере прихода фрагментов"""
+    max_tokens = completion_max_tokens(path, style)
+    payload = build_completion_payload(prompt, style, stream=True, max_tokens=max_tokens)
+    
+    async with llm_scheduler.slot(user_id, completion_cost(prompt, max_tokens)):
+        session = await gpt_client.get_session()
+        async with session.post(YANDEX_API_URL, json=payload) as response:
+            if response.status != 200:
+                yield "Давай поговорим о чем-то другом? Что тебя интересует?"
+                return
+            
+            # Каждая строка ответа - JSON с полным текстом, сгенерированным к этому моменту
+            text, usage = '', None
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+                data = json.loads(line)
+                text = data['result']['alternatives'][0]['message']['text']
+                usage = data['result'].get('usage') or usage
+                yield text
+            token_usage.record(path, prompt, text, max_tokens, usage)
+
+class StreamingReply:
+    """Постепенный вывод ответа в Telegram.
+    
+    Первое сообщение отправляется, как только готово первое предложение,
+    дальше оно правится не чаще раза в edit_interval секунд и только по
+    границам предложений, чтобы не упираться в лимиты Telegram на правки.
+    
+    Поток модели читается без ожидания Telegram: push() только запоминает
+    последний текст, а отправкой и правками занимается отдельная задача,
+    которая берет самый свежий текст, когда очередь исходящих ее пропустит.
+    """
+    
+    SENTENCE_END = re.compile(r'[.!?…](?=\s|$)')
+    
+    def __init__(self, message, edit_interval=STREAM_EDIT_INTERVAL, max_edits=STREAM_MAX_EDITS,
+                 not_before=0.0):
+        self.message = message
+        self.not_before = not_before
+        self.edit_interval = edit_interval
+        self.max_edits = max_edits
+        self.sent = None
+        self.shown = ''
+        self.edits = 0
+        self.last_update = 0.0
+        self._latest = ''
+        self._changed = asyncio.Event()
+        self._closing = False
+        self._pump_task = None
+    
+    def push(self, text):
+        """Новый накопленный текст от модели; не ждет отправки"""
+        self._latest = text
+        self._changed.set()
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+    
+    async def _pump(self):
+        while not self._closing:
+            await self._changed.wait()
+            self._changed.clear()
+            if self._closing:
+                break
+            try:
+                await self.update(self._latest)
+            except Exception as e:
+                logger.error(f"Ошибка промежуточной отправки ответа: {e}")
+    
+    def cancel(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = None
+    
+    async def _stop_pump(self):
+        """Остановка фоновой отправки после текущего вызова Bot API"""
+        if self._pump_task is not None:
+            self._closing = True
+            self._changed.set()
+            await self._pump_task
+            self._pump_task = None
+    
+    def _complete_sentences(self, text):
+        """Текст до последней законченной фразы"""
+        last = None
+        for last in self.SENTENCE_END.finditer(text):
+            pass
+        return text[:last.end()].strip() if last else ''
+    
+    async def _edit(self, text, priority=PRIORITY_EDIT):
+        try:
+            await edit_reply(self.sent, text, priority)
+        except BadRequest as e:
+            # "Message is not modified" и подобные - не повод прерывать ответ
+            logger.debug(f"Правка сообщения пропущена: {e}")
+        self.edits += 1
+        self.shown = text
+        self.last_update = time.monotonic()
+    
+    async def update(self, text):
+        """Новый накопленный текст от модели"""
+        visible = self._complete_sentences(text)
+        if not visible or visible == self.shown:
+            return
+        
+        if self.sent is None:
+            # Первое сообщение - не раньше, чем "человек" успел бы его напечатать
+            if time.monotonic() < self.not_before:
+                return
+            self.sent = await send_reply(self.message, visible)
+            self.shown = visible
+            self.last_update = time.monotonic()
+        elif (time.monotonic() - self.last_update >= self.edit_interval
+              and self.edits < self.max_edits):
+            await self._edit(visible)
+    
+    async def finish(self, text):
+        """Финальный текст ответа.
+        
+        Если сообщение уже отправлено, ошибка финальной правки только
+        логируется: пользователь видит начало ответа, а повторная генерация
+        прислала бы второе сообщение.
+        """
+        await self._stop_pump()
+        if self.sent is None:
+            await sleep_until(self.not_before)
+            self.sent = await send_reply(self.message, text)
+            self.shown = text
+            return text
+        
+        if text != self.shown:
+            wait = self.edit_interval - (time.monotonic() - self.last_update)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await self._edit(text, PRIORITY_REPLY)
+            except TelegramError as e:
+                logger.error(f"Ошибка финальной правки ответа: {e}")
+        return text
+
+async def sleep_until(deadline):
+    """Ожидание до момента deadline по time.monotonic()"""
+    delay = deadline - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+@asynccontextmanager
+async def typing_action(chat):
+    """Статус "печатает..." в чате, пока выполняется блок"""
+    async def keep_typing():
+        while True:
+            try:
+                # Через очередь исходящих: статус делит лимиты чата с ответами и ждет паузы после 429
+                await outbound_sender.send(chat.id, lambda: chat.send_action(ChatAction.TYPING), PRIORITY_TYPING)
+            except Exception as e:
+                logger.debug(f"Не удалось отправить статус печати: {e}")
+            # Статус в Telegram гаснет через ~5 секунд
+            await asyncio.sleep(4.5)
+    
+    task = asyncio.create_task(keep_typing())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+async def reply_with_ai_response(message, prompt, style, finalize=None, user_id=None, not_before=0.0,
+                                 path='deep'):
+    """Генерация ответа и отправка пользователю; в потоковом режиме - с постепенной правкой.
+    
+    Ответ показывается не раньше not_before (time.monotonic()), если модель
+    ответила быстрее имитируемого человеческого времени.
+    """
+    if not STREAM_REPLIES:
+        bot_response = await generate_ai_response(prompt, style, user_id, path)
+        if finalize:
+            bot_response = finalize(bot_response)
+        await sleep_until(not_before)
+        await send_reply(message, bot_response)
+        return bot_response
+    
+    reply = StreamingReply(message, not_before=not_before)
+    text = ''
+    try:
+        try:
+            async for text in stream_ai_response(prompt, style, user_id, path):
+                reply.push(text)
+        except LLMQueueTimeout as e:
+            logger.warning(f"Очередь к Yandex GPT переполнена: {e}")
+            text = BUSY_RESPONSE
+        except Exception as e:
+            logger.error(f"Ошибка потоковой генерации Yandex GPT: {e}")
+            if not text:
+                text = "Извини, я немного запуталась... Можешь повторить?"
+        
+        bot_response = finalize(text) if finalize else text
+        await reply.finish(bot_response)
+        return bot_response
+    finally:
+        # При отмене хода фоновая отправка не должна пережить его
+        reply.cancel()
+
+def _load_summary_input(conn: sqlite3.Connection, user_id: int, batch: int):
+    """Текущее резюме и самые старые обмены, которые еще не свернуты в него"""
+    state = conn.execute(HOT_QUERIES['summary_state'], (user_id,)).fetchone()
+    summary, last_message_id, folded = state if state else ('', 0, 0)
+    rows = conn.execute(HOT_QUERIES['unsummarized_messages'], (user_id, last_message_id, batch)).fetchall()
+    return summary, folded, rows
+
+def _store_summary(conn: sqlite3.Connection, user_id: int, summary: str,
+                   last_message_id: int, folded: int):
+    conn.execute("""
+        INSERT INTO conversation_summary (user_id, summary, last_message_id, messages_folded, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET
+            summary = excluded.summary,
+            last_message_id = excluded.last_message_id,
+            messages_folded = excluded.messages_folded,
+            updated_at = CURRENT_TIMESTAMP
+    """, (user_id, summary, last_message_id, folded))
+
+class ConversationSummarizer:
+    """Фоновое сворачивание старых обменов в краткое резюме беседы.
+    
+    Раз в every сообщений пользователь ставится в очередь, и фоновая задача
+    дописывает в его резюме обмены, появившиеся после прошлого
+    сворачивания, от старых к новым по batch за раз; пока остается
+    несвернутая история, пользователь снова встает в конец очереди. Запросы к модели идут через
+    общий поток планировщика с малым весом, поэтому ответы пользователям
+    всегда обслуживаются раньше. Резюме ограничено max_chars, так что
+    промпт не растет вместе с историей.
+    """
+    
+    FLOW = 'summary'
+    
+    def __init__(self, every=SUMMARY_EVERY_MESSAGES, batch=SUMMARY_MAX_BATCH,
+                 max_chars=SUMMARY_MAX_CHARS, weight=SUMMARY_LLM_WEIGHT):
+        self.every = every
+        self.batch = batch
+        self.max_chars = max_chars
+        self.weight = weight
+        self._queue = None
+        self._pending = set()
+        self._task = None
+        self._stats = {'scheduled': 0, 'summaries': 0, 'failures': 0, 'messages_folded': 0}
+    
+    def note_message(self, user_id: int, messages_count: int):
+        """Учет нового сообщения: каждое every-е ставит пользователя в очередь"""
+        if not self.every or messages_count % self.every:
+            return
+        self._schedule(user_id)
+    
+    def _schedule(self, user_id: int):
+        if self._queue is not None and user_id not in self._pending:
+            self._pending.add(user_id)
+            self._queue.put_nowait(user_id)
+            self._stats['scheduled'] += 1
+    
+    def start(self):
+        """Запуск фоновой задачи"""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._pending.clear()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановка фоновой задачи; незавершенные резюме обновятся позже"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._queue = None
+    
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
+            self._pending.discard(user_id)
+            try:
+                if await self.summarize(user_id):
+                    # Осталась несвернутая история - продолжим после остальных пользователей
+                    self._schedule(user_id)
+            except LLMQueueTimeout:
+                # Модель занята ответами - пользователь попадет в очередь при следующем сроке
+                self._stats['failures'] += 1
+            except Exception as e:
+                self._stats['failures'] += 1
+                logger.error(f"Ошибка резюме беседы пользователя {user_id}: {e}")
+    
+    def _prompt(self, summary: str, exchanges: List[tuple]) -> str:
+        dialogue = '\n'.join(
+            f"Пользователь: {message_text}\nБот: {bot_response}"
+            for _, message_text, bot_response in exchanges
+        )
+        return f"""
+Текущее резюме беседы: {summary or 'пока пусто'}
+
+Новые сообщения:
+{dialogue}
+
+Обнови резюме: сохрани важные факты о пользователе, темы и договоренности,
+добавь новое из сообщений. Пиши кратко, в третьем лице, не длиннее {self.max_chars} символов.
+Резюме:
+"""
+    
+    def _clip(self, text: str) -> str:
+        """Обрезка резюме по границе предложения в пределах max_chars"""
+        text = ' '.join(text.split())
+        if len(text) <= self.max_chars:
+            return text
+        clipped = text[:self.max_chars]
+        last = max(clipped.rfind('. '), clipped.rfind('! '), clipped.rfind('? '))
+        return clipped[:last + 1] if last > 0 else clipped
+    
+    async def _complete(self, prompt: str) -> str:
+        payload = build_completion_payload(prompt, 'reactive', max_tokens=SUMMARY_MAX_TOKENS)
+        payload['messages'][0]['text'] = "Ты ведешь краткие заметки о беседе."
+        
+        async with llm_scheduler.slot(self.FLOW, estimate_tokens(prompt) + SUMMARY_MAX_TOKENS, self.weight):
+            session = await gpt_client.get_session()
+            async with session.post(YANDEX_API_URL, json=payload) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"Yandex GPT вернул {response.status}")
+                data = await response.json()
+                text = data['result']['alternatives'][0]['message']['text']
+                token_usage.record('summary', prompt, text, SUMMARY_MAX_TOKENS, data['result'].get('usage'))
+                return text
+    
+    async def summarize(self, user_id: int) -> bool:
+        """Дописывание следующей пачки обменов в резюме; True, если пачка была полной"""
+        if write_queue.has_pending(user_id):
+            await write_queue.flush()
+        
+        summary, folded, exchanges = await user_database.read(_load_summary_input, user_id, self.batch)
+        if not exchanges:
+            return False
+        
+        summary = self._clip(await self._complete(self._prompt(summary, exchanges)))
+        if not summary:
+            return False
+        
+        last_message_id = max(message_id for message_id, _, _ in exchanges)
+        await user_database.write(_store_summary, user_id, summary, last_message_id, folded + len(exchanges))
+        conversation_context.apply_summary(user_id, summary)
+        self._stats['summaries'] += 1
+        self._stats['messages_folded'] += len(exchanges)
+        return len(exchanges) == self.batch
+    
+    def stats(self) -> Dict[str, Any]:
+        """Очередь и число построенных резюме"""
+        return dict(self._stats, queued=len(self._pending))
+
+conversation_summarizer = ConversationSummarizer()
+
 async def context_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать текущий контекст"""
     user_id = update.effective_user.id
-    user_context = get_user_context(user_id)
+    user_context = await get_user_context(user_id)
     
     response = "📊 Текущий контекст беседы:\n\n"
     
@@ -1381,12 +3921,12 @@ async def context_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         response += f"🏃 Темп: {dc.get('conversation_rhythm', {}).get('pace', 'medium')}\n"
         response += f"💭 Воспоминаний: {len(dc.get('historical_topics', {}))}\n"
     
-    await update.message.reply_text(response)
+    await send_reply(update.message, response, PRIORITY_DIAGNOSTIC)
 
 async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать память о беседе"""
     user_id = update.effective_user.id
-    user_context = get_user_context(user_id)
+    user_context = await get_user_context(user_id)
     
     response = "🧠 Память о наших разговорах:\n\n"
     
@@ -1400,7 +3940,430 @@ async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             response += "Еще нет сохраненных тем"
     
-    await update.message.reply_text(response)
+    await send_reply(update.message, response, PRIORITY_DIAGNOSTIC)
+
+# Фоновые задачи приложения
+background_tasks = set()
+
+def collect_metrics() -> Dict[str, Any]:
+    """Сбор метрик подсистем"""
+    return {
+        'write_queue': write_queue.stats(),
+        'context_cache': conversation_context.stats(),
+        'llm_scheduler': llm_scheduler.stats(),
+        'coalescer': message_coalescer.stats(),
+        'user_lanes': user_lanes.stats(),
+        'turns': in_flight_turns.stats(),
+        'idempotency': processed_updates.stats(),
+        'analysis_stage': analysis_stage.stats(),
+        'vector_memory': vector_memory.stats(),
+        'summarizer': conversation_summarizer.stats(),
+        'webhook': webhook_server.stats(),
+        'outbound': outbound_sender.stats(),
+        'tokens': token_usage.stats()
+    }
+
+async def report_metrics():
+    """Периодическая запись метрик в лог"""
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        logger.info(f"📊 Метрики: {json.dumps(collect_metrics(), ensure_ascii=False)}")
+
+async def prune_processed_updates():
+    """Периодическая очистка таблицы обработанных сообщений"""
+    while True:
+        try:
+            await processed_updates.prune()
+        except Exception as e:
+            logger.error(f"Ошибка очистки processed_updates: {e}")
+        await asyncio.sleep(3600)
+
+async def on_startup(application: Application):
+    """Запуск фоновых подсистем"""
+    write_queue.start()
+    outbound_sender.start()
+    conversation_summarizer.start()
+    await gpt_client.start()
+    for task in (asyncio.create_task(report_metrics()), asyncio.create_task(prune_processed_updates())):
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def on_shutdown(application: Application):
+    """Освобождение ресурсов после остановки приложения"""
+    for task in list(background_tasks):
+        task.cancel()
+    await conversation_summarizer.stop()
+    await outbound_sender.stop()
+    await gpt_client.close()
+    await write_queue.stop()
+    logger.info(f"📊 Метрики: {json.dumps(collect_metrics(), ensure_ascii=False)}")
+    await asyncio.get_running_loop().run_in_executor(None, analysis_stage.close)
+    await asyncio.get_running_loop().run_in_executor(None, user_database.close)
+
+class WebhookServer:
+    """Встроенный HTTP-сервер для приема обновлений Telegram через вебхук.
+    
+    Проверяет секретный заголовок и кладет обновления в ограниченную очередь
+    приложения. Если очередь заполнена, отвечает 503 - Telegram повторит доставку.
+    """
+    
+    SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+    
+    def __init__(self, path=WEBHOOK_PATH, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, secret=WEBHOOK_SECRET):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self._application = None
+        self._runner = None
+        self._stats = {'accepted': 0, 'rejected_full': 0, 'forbidden': 0, 'malformed': 0}
+    
+    async def start(self, application: Application):
+        """Запуск сервера; обновления идут в application.update_queue"""
+        self._application = application
+        
+        app = web.Application()
+        app.router.add_post(self.path, self._handle_update)
+        app.router.add_get('/healthz', self._handle_health)
+        
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"🌐 Вебхук слушает {self.host}:{self.port}{self.path}")
+    
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+    
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(self.SECRET_HEADER, ''), self.secret):
+            self._stats['forbidden'] += 1
+            return web.Response(status=403)
+        
+        try:
+            update = Update.de_json(await request.json(), self._application.bot)
+        except Exception as e:
+            self._stats['malformed'] += 1
+            logger.error(f"Некорректное обновление в вебхуке: {e}")
+            return web.Response(status=400)
+        
+        try:
+            self._application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self._stats['rejected_full'] += 1
+            return web.Response(status=503, headers={'Retry-After': '1'})
+        
+        self._stats['accepted'] += 1
+        return web.Response()
+    
+    async def _handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+    
+    def stats(self) -> Dict[str, Any]:
+        queue = self._application.update_queue if self._application else None
+        return {
+            **self._stats,
+            'queue_depth': queue.qsize() if queue else 0
+        }
+
+webhook_server = WebhookServer()
+
+async def run_application(application: Application):
+    """Жизненный цикл приложения: прием обновлений до SIGTERM/SIGINT, затем дренаж"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    
+    try:
+        if application.updater:
+            await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        else:
+            await webhook_server.start(application)
+            if WEBHOOK_URL and WEBHOOK_REGISTER:
+                await application.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=ALLOWED_UPDATES,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS
+                )
+                logger.info(f"🔗 Вебхук зарегистрирован: {WEBHOOK_URL}")
+        
+        await stop_event.wait()
+    finally:
+        await drain_application(application)
+
+async def drain_application(application: Application, timeout: float = SHUTDOWN_DRAIN_TIMEOUT):
+    """Остановка без потери сообщений: прием, начатые ходы, отложенные записи, соединения"""
+    started = time.monotonic()
+    logger.info("🛑 Останавливаю прием обновлений...")
+    
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    await webhook_server.stop()
+    
+    abandoned = await in_flight_turns.drain(application.update_queue, started + timeout)
+    
+    # on_shutdown досылает исходящие, сбрасывает очередь записи и закрывает пулы
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    
+    logger.info(f"🛑 Бот остановлен за {time.monotonic() - started:.1f} с, брошено ходов: {abandoned}")
+
+def user_shard(user_id: int, shards: int) -> int:
+    """Номер воркера пользователя: стабильный между запусками хеш user_id"""
+    return zlib.crc32(str(user_id).encode()) % shards
+
+def update_shard(update: Dict[str, Any], shards: int) -> int:
+    """Номер воркера для обновления"""
+    message = update.get('message') or {}
+    user = message.get('from') or message.get('chat') or {}
+    return user_shard(user.get('id', 0), shards)
+
+def shard_database_name(index: int) -> str:
+    """Файл базы воркера при WORKER_SHARD_DATABASES=1"""
+    stem, extension = os.path.splitext(DB_NAME)
+    return f"{stem}.shard{index}{extension}"
+
+class WorkerSupervisor:
+    """Супервизор процессов-воркеров.
+    
+    Принимает обновления (вебхуком или long polling) и пересылает каждое
+    воркеру по хешу user_id, так что состояние пользователя - кэш контекста,
+    векторная память, резюме - живет в одном процессе. Упавшие воркеры
+    перезапускаются.
+    """
+    
+    def __init__(self, processes=WORKER_PROCESSES):
+        self.processes = max(1, processes)
+        # Общий секрет для пересылки воркерам; в режиме polling его нет в окружении
+        self.secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        self._workers: List[Optional[subprocess.Popen]] = [None] * self.processes
+        self._session = None
+        self._runner = None
+        self._stopping = False
+        self._stats = {
+            'forwarded': [0] * self.processes,
+            'unavailable': 0,
+            'restarts': 0
+        }
+    
+    def worker_port(self, index: int) -> int:
+        return WEBHOOK_PORT + 1 + index
+    
+    def _spawn(self, index: int):
+        env = dict(
+            os.environ,
+            WORKER_INDEX=str(index),
+            WEBHOOK_LISTEN='127.0.0.1',
+            WEBHOOK_PORT=str(self.worker_port(index)),
+            WEBHOOK_SECRET=self.secret,
+            WEBHOOK_REGISTER='0'
+        )
+        if WORKER_SHARD_DATABASES:
+            env['DB_NAME'] = shard_database_name(index)
+        self._workers[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        logger.info(f"👷 Воркер {index} запущен (pid {self._workers[index].pid}, порт {self.worker_port(index)})")
+    
+    async def _wait_ready(self):
+        """Ожидание, пока все воркеры начнут принимать обновления"""
+        deadline = time.monotonic() + WORKER_STARTUP_TIMEOUT
+        for index in range(self.processes):
+            while True:
+                try:
+                    async with self._session.get(f"http://127.0.0.1:{self.worker_port(index)}/healthz"):
+                        break
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"Воркер {index} не запустился за {WORKER_STARTUP_TIMEOUT} с")
+                    await asyncio.sleep(0.2)
+    
+    async def _monitor(self):
+        """Перезапуск упавших воркеров"""
+        while not self._stopping:
+            await asyncio.sleep(1)
+            for index, worker in enumerate(self._workers):
+                if worker.poll() is not None and not self._stopping:
+                    logger.error(f"Воркер {index} завершился с кодом {worker.returncode}, перезапускаю")
+                    self._stats['restarts'] += 1
+                    # Воркер мог упасть между записью .vec и .ids; файлы его
+                    # пользователей никто другой не пишет, их можно чинить
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, vector_memory.repair,
+                        lambda user_id, index=index: user_shard(user_id, self.processes) == index
+                    )
+                    self._spawn(index)
+    
+    async def forward(self, update: Dict[str, Any], body: Optional[bytes] = None) -> int:
+        """Пересылка обновления воркеру; возвращает HTTP-статус ответа воркера"""
+        index = update_shard(update, self.processes)
+        try:
+            async with self._session.post(
+                f"http://127.0.0.1:{self.worker_port(index)}{WEBHOOK_PATH}",
+                data=body if body is not None else json.dumps(update),
+                headers={WebhookServer.SECRET_HEADER: self.secret, 'Content-Type': 'application/json'}
+            ) as response:
+                if response.status == 200:
+                    self._stats['forwarded'][index] += 1
+                return response.status
+        except aiohttp.ClientError:
+            # Воркер перезапускается - обновление будет доставлено повторно
+            self._stats['unavailable'] += 1
+            return 503
+    
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(WebhookServer.SECRET_HEADER, ''), WEBHOOK_SECRET):
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        status = await self.forward(update, body)
+        return web.Response(status=status, headers={'Retry-After': '1'} if status == 503 else None)
+    
+    async def _handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+    
+    async def _serve_webhook(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self._handle_update)
+        app.router.add_get('/healthz', self._handle_health)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        
+        if WEBHOOK_REGISTER:
+            async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+                await bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=ALLOWED_UPDATES,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS
+                )
+        logger.info(f"🌐 Супервизор принимает вебхук на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    async def _poll(self):
+        """Long polling в супервизоре: offset сдвигается только после приема воркером"""
+        async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+            await bot.delete_webhook()
+            offset = None
+            while not self._stopping:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES)
+                except Conflict as e:
+                    logger.error(f"Конфликт обнаружен: {e}")
+                    await asyncio.sleep(5)
+                    continue
+                except Exception as e:
+                    logger.error(f"Ошибка получения обновлений: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                
+                for update in updates:
+                    while await self.forward(update.to_dict()) == 503 and not self._stopping:
+                        await asyncio.sleep(1)
+                    offset = update.update_id + 1
+    
+    async def run(self):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+        
+        for index in range(self.processes):
+            self._spawn(index)
+        
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        tasks = []
+        try:
+            await self._wait_ready()
+            logger.info(f"🤖 Супервизор запущен: {self.processes} воркеров")
+            tasks.append(asyncio.create_task(self._monitor()))
+            if WEBHOOK_URL:
+                await self._serve_webhook()
+            else:
+                tasks.append(asyncio.create_task(self._poll()))
+            await stop_event.wait()
+        finally:
+            print("\n🛑 Останавливаю воркеров...")
+            self._stopping = True
+            for task in tasks:
+                task.cancel()
+            if self._runner:
+                await self._runner.cleanup()
+            for worker in self._workers:
+                if worker and worker.poll() is None:
+                    worker.terminate()
+            for worker in self._workers:
+                if worker:
+                    await loop.run_in_executor(None, worker.wait)
+            await self._session.close()
+            logger.info(f"📊 Супервизор: {json.dumps(self.stats(), ensure_ascii=False)}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            'alive': sum(1 for worker in self._workers if worker and worker.poll() is None)
+        }
+
+def _check_shard_layout(conn: sqlite3.Connection, index: int, count: int) -> Optional[str]:
+    """Сверка раскладки шардов с записанной в базе; при первом запуске - запись"""
+    row = conn.execute("SELECT shard_index, shard_count FROM shard_layout WHERE id = 1").fetchone()
+    if row is None:
+        with conn:
+            conn.execute(
+                "INSERT INTO shard_layout (id, shard_index, shard_count) VALUES (1, ?, ?)", (index, count)
+            )
+        return None
+    if row != (index, count):
+        return f"база {shard_database_name(index)} - шард {row[0]} из {row[1]}, а не {index} из {count}"
+    return None
+
+def prepare_shard_databases(count: int) -> bool:
+    """Миграции баз шардов и проверка, что пользователи не переехали в другие шарды"""
+    for index in range(count):
+        database = UserDatabase(shard_database_name(index))
+        database.init_database(check_plans=False)
+        problem = _check_shard_layout(database._connection(), index, count)
+        database.close()
+        if problem:
+            logger.error(f"❌ Изменилось число шардов: {problem}. Верните WORKER_PROCESSES или перенесите данные")
+            return False
+    return True
+
+def supervise():
+    """Запуск воркеров с шардированием по user_id: python main.py supervise"""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("❌ TELEGRAM_BOT_TOKEN не найден!")
+        return
+    
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("❌ Для режима вебхука нужен WEBHOOK_SECRET!")
+        return
+    
+    # Миграции - до запуска воркеров, чтобы они не применялись параллельно
+    if WORKER_SHARD_DATABASES:
+        if not os.getenv("WORKER_PROCESSES"):
+            logger.error("❌ При WORKER_SHARD_DATABASES=1 нужно явно задать WORKER_PROCESSES!")
+            return
+        if not prepare_shard_databases(WORKER_PROCESSES):
+            return
+    else:
+        user_database.init_database(check_plans=False)
+        user_database.close()
+    
+    # Хвосты векторных файлов чинятся до запуска воркеров, которые их дописывают
+    vector_memory.repair()
+    
+    asyncio.run(WorkerSupervisor().run())
 
 def main():
     """Основная функция"""
@@ -1408,28 +4371,37 @@ def main():
         logger.error("❌ TELEGRAM_BOT_TOKEN не найден!")
         return
     
-    UserDatabase()
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("❌ Для режима вебхука нужен WEBHOOK_SECRET!")
+        return
+    
+    user_database.init_database()
+    if not WORKER_INDEX:
+        # Воркерам файлы чинит супервизор до их запуска
+        vector_memory.repair()
     
-    application = (
+    builder = (
         Application.builder()
         .token(TELEGRAM_BOT_TOKEN)
-        .concurrent_updates(True)
-        .build()
+        .concurrent_updates(TrackedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
     )
+    if WEBHOOK_URL or WORKER_INDEX:
+        # Обновления приходят во встроенный сервер, updater для polling не нужен
+        builder = builder.updater(None)
+    application = builder.build()
     
     application.add_handler(CommandHandler("context", context_command))
     application.add_handler(CommandHandler("memory", memory_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, process_message_with_deep_context))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     application.add_error_handler(error_handler)
     
     logger.info("🤖 Бот запущен и готов к общению...")
     
     try:
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            close_loop=False,
-            stop_signals=None
-        )
+        asyncio.run(run_application(application))
     except Conflict as e:
         logger.error(f"Конфликт обнаружен: {e}")
         logger.info("Перезапуск бота через 5 секунд...")
@@ -1438,8 +4410,173 @@ def main():
     except Exception as e:
         logger.error(f"Неожиданная ошибка: {e}")
 
+def check_database():
+    """Миграции и проверка планов запросов по требованию: python main.py check-db"""
+    user_database.init_database(check_plans=False)
+    problems = user_database.check_query_plans()
+    user_database.close()
+    sys.exit(1 if problems else 0)
+
+def benchmark_topics():
+    """Замер извлечения тем на длинных сообщениях: python main.py bench-topics"""
+    def legacy_extract(text):
+        # Прежняя реализация: words.count для каждого уникального слова и полная сортировка
+        words = re.findall(r'\b[а-яё]{3,}\b', text.lower())
+        topics = {}
+        for word in set(words):
+            weight = words.count(word) * 0.3
+            if word in text[:50]:
+                weight += 0.2
+            topics[word] = min(1.0, weight)
+        return dict(sorted(topics.items(), key=lambda x: x[1], reverse=True)[:5])
+    
+    vocabulary = [
+        ''.join(random.choice('абвгдеёжзийклмнопрстуфхцчшщыэюя') for _ in range(random.randint(3, 10)))
+        for _ in range(5000)
+    ]
+    
+    for words_count in (100, 1000, 10000, 50000):
+        text = ' '.join(random.choice(vocabulary) for _ in range(words_count))
+        for name, extract in (('новый', topic_extractor.extract), ('прежний', legacy_extract)):
+            if name == 'прежний' and words_count > 10000:
+                continue
+            runs = max(1, 20000 // words_count)
+            started = time.perf_counter()
+            for _ in range(runs):
+                extract(text)
+            elapsed_ms = (time.perf_counter() - started) / runs * 1000
+            print(f"{words_count:>6} слов, {name:>7}: {elapsed_ms:9.2f} мс")
+
+def build_memory_vectors():
+    """Перестроение векторной памяти по всем сообщениям: python main.py build-vectors
+    
+    Запускается при остановленном боте (например, после обновления).
+    """
+    user_database.init_database(check_plans=False)
+    vector_memory.repair()
+    conn = user_database._connection()
+    
+    user_ids = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM messages")]
+    for user_id in user_ids:
+        vector_memory.drop(user_id)
+        rows = conn.execute(
+            "SELECT id, message_text FROM messages WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+        vector_memory.add_many([
+            (user_id, message_id, memory_vectorizer.transform(message_text or ''))
+            for message_id, message_text in rows
+        ])
+        logger.info(f"🧠 Векторы пользователя {user_id}: {len(rows)}")
+    
+    user_database.close()
+
+def _stored_analysis(message_text: str, analysis: Optional[str]) -> Dict[str, Any]:
+    """Сохраненный анализ сообщения; для старых строк без него - вычисленный заново"""
+    stored = json.loads(analysis) if analysis else {}
+    if stored.get('topics') is None or stored.get('emotional_score') is None:
+        stored = {**analyze_message(message_text or ''), **stored}
+    return stored
+
+def backfill_history(batch: int = 1000):
+    """Заполнение индекса тем и накопленной статистики по старым сообщениям: python main.py backfill
+    
+    Миграции 5 и 6 создают только схему, чтобы не держать блокировку записи
+    при запуске. Запускается при остановленном боте после обновления; каждая
+    пачка пишется своей транзакцией, повторный запуск безопасен.
+    """
+    user_database.init_database(check_plans=False)
+    conn = user_database._connection()
+    
+    # Индекс тем: по batch сообщений за транзакцию
+    last_id, messages_done = 0, 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, user_id, message_text, analysis FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, batch)
+        ).fetchall()
+        if not rows:
+            break
+        with conn:
+            conn.executemany(HOT_QUERIES['insert_topic_posting'], [
+                (user_id, topic, message_id)
+                for message_id, user_id, message_text, analysis in rows
+                for topic in _stored_analysis(message_text, analysis)['topics']
+            ])
+        last_id = rows[-1][0]
+        messages_done += len(rows)
+    logger.info(f"🗂 Индекс тем заполнен: {messages_done} сообщений")
+    
+    # Статистика - для пользователей, у которых ее еще нет
+    user_ids = [row[0] for row in conn.execute("""
+        SELECT DISTINCT m.user_id FROM messages m
+        LEFT JOIN conversation_context c ON c.user_id = m.user_id
+        WHERE c.running_stats IS NULL
+    """)]
+    for user_id in user_ids:
+        stats = ConversationStats()
+        cursor = conn.execute(
+            "SELECT message_text, analysis, timestamp FROM messages WHERE user_id = ? ORDER BY timestamp, id",
+            (user_id,)
+        )
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            for message_text, analysis, timestamp in rows:
+                stats.update(
+                    _stored_analysis(message_text, analysis)['emotional_score'],
+                    datetime.fromisoformat(timestamp) if isinstance(timestamp, str) else timestamp
+                )
+        with conn:
+            conn.execute("""
+                INSERT INTO conversation_context (user_id, running_stats) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET running_stats = excluded.running_stats
+            """, (user_id, json.dumps(stats.to_dict())))
+    logger.info(f"📈 Статистика бесед заполнена: {len(user_ids)} пользователей")
+    
+    user_database.close()
+
+def benchmark_vectors():
+    """Замер поиска по векторной памяти: python main.py bench-vectors"""
+    import tempfile
+    
+    vocabulary = [
+        ''.join(random.choice('абвгдеёжзийклмнопрстуфхцчшщыэюя') for _ in range(random.randint(3, 10)))
+        for _ in range(5000)
+    ]
+    
+    def message():
+        return ' '.join(random.choice(vocabulary) for _ in range(random.randint(3, 20)))
+    
+    with tempfile.TemporaryDirectory() as directory:
+        for rows_count in (10000, 100000):
+            memory = VectorMemory(directory=directory)
+            started = time.perf_counter()
+            vectors = [memory_vectorizer.transform(message()) for _ in range(rows_count)]
+            vectorize_ms = (time.perf_counter() - started) / rows_count * 1000
+            memory.add_many([(rows_count, message_id, vector) for message_id, vector in enumerate(vectors)])
+            
+            queries = [memory_vectorizer.transform(message()) for _ in range(100)]
+            memory.search(rows_count, queries[0])
+            started = time.perf_counter()
+            for query in queries:
+                memory.search(rows_count, query)
+            search_ms = (time.perf_counter() - started) / len(queries) * 1000
+            
+            mapped = 'memmap' if memory._index(rows_count).mapped else 'память'
+            print(f"{rows_count:>6} сообщений ({mapped}): векторизация {vectorize_ms:.3f} мс/сообщение, "
+                  f"поиск top-{MEMORY_VECTOR_TOP_K} {search_ms:.2f} мс")
+
 if __name__ == "__main__":
-    main()
+    commands = {
+        'check-db': check_database,
+        'bench-topics': benchmark_topics,
+        'build-vectors': build_memory_vectors,
+        'backfill': backfill_history,
+        'bench-vectors': benchmark_vectors,
+        'supervise': supervise
+    }
+    commands.get(sys.argv[1] if len(sys.argv) > 1 else None, main)()
 
 
 